@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for sensor reads, the upload path and the full cycle.
+
+Run from the root of the repository:
+
+    $ python3 -m benchmarks -o results.json
+    $ python3 -m benchmarks --compare results.json
+
+Sensors run against static kernel interface files or simulated hardware, and
+uploads go to a local stand-in for the API server, so no Raspberry Pi or
+network is needed.
+"""
+
+import argparse
+import collections
+from datetime import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+import types
+
+import therminator
+from therminator import api, hardware
+from therminator.__main__ import measure, post
+from therminator.led import NullLED
+from therminator.sensors import ds18b20, photoresistor, pi
+
+from .server import StandInServer
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+def timed(func, n):
+    """Call func n times and return the duration of each call in seconds."""
+    samples = []
+    for _ in range(n):
+        t1 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t1)
+    return samples
+
+def summarize(samples, **extra):
+    samples = sorted(samples)
+    result = dict(
+        n=len(samples),
+        mean=statistics.mean(samples),
+        median=statistics.median(samples),
+        p95=samples[min(int(len(samples) * 0.95), len(samples)-1)],
+        min=samples[0],
+        max=samples[-1],
+        unit='s',
+    )
+    result.update(extra)
+    return result
+
+def _tempfile(data):
+    fd, file = tempfile.mkstemp(prefix='therminator-bench-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    return file
+
+
+@benchmark('pi.read')
+def bench_pi_read(n):
+    file = _tempfile('45123\n')
+    try:
+        return summarize(timed(lambda: pi.read(file), n))
+    finally:
+        os.unlink(file)
+
+@benchmark('ds18b20._read')
+def bench_ds18b20_read(n):
+    raw = '50 01 4b 46 7f ff 0c 10 1c'
+    file = _tempfile('{} : crc=1c YES\n{} t=21125\n'.format(raw, raw))
+    try:
+        return summarize(timed(lambda: ds18b20._read(file, timeout=1, wait=0.01), n))
+    finally:
+        os.unlink(file)
+
+def _bench_photoresistor(n, edge):
+    # With no resistance in the circuit the capacitor charges instantly, so
+    # each sample measures only the client's overhead.
+    hardware.use('simulated', light=0, resistance=0, noise=0)
+    try:
+        return summarize(timed(
+            lambda: photoresistor._read((22, 17), C=0.1, R=0, V=3.3, edge=edge, wait=0),
+            n,
+        ))
+    finally:
+        hardware.use('rpi')
+
+@benchmark('photoresistor._read[poll]')
+def bench_photoresistor_poll(n):
+    return _bench_photoresistor(n, edge=False)
+
+@benchmark('photoresistor._read[edge]')
+def bench_photoresistor_edge(n):
+    return _bench_photoresistor(n, edge=True)
+
+READING = dict(
+    timestamp='2017-01-01T00:00:00',
+    int_temp=45.1,
+    ext_temp=21.1,
+    humidity=45.0,
+    resistance=10000.0,
+)
+
+@benchmark('api.write[keep-alive]')
+def bench_api_keepalive(n):
+    with StandInServer() as server:
+        client = api.Client(server.url, 'bench')
+        try:
+            return summarize(timed(lambda: client.write(READING), n))
+        finally:
+            client.close()
+
+@benchmark('api.write[new-connection]')
+def bench_api_new_connection(n):
+    def write():
+        client = api.Client(server.url, 'bench')
+        try:
+            client.write(READING)
+        finally:
+            client.close()
+
+    with StandInServer() as server:
+        return summarize(timed(write, n))
+
+@benchmark('api.write[20%-failures]')
+def bench_api_failures(n):
+    with StandInServer(failure_rate=0.2) as server:
+        client = api.Client(server.url, 'bench', retries=10, delay=0)
+        try:
+            samples = timed(lambda: client.write(READING), n)
+        finally:
+            client.close()
+        return summarize(samples, attempts=server.requests / n)
+
+@benchmark('api.write_batch[100]')
+def bench_api_batch(n):
+    readings = [READING] * 100
+    with StandInServer() as server:
+        client = api.Client(server.url, 'bench', batch_endpoint=server.url)
+        try:
+            samples = timed(lambda: client.write_batch(readings), n)
+        finally:
+            client.close()
+        return summarize(samples, readings_per_second=len(readings) / statistics.mean(samples))
+
+@benchmark('cycle')
+def bench_cycle(n):
+    hardware.use('simulated', dht_latency=0, dht_failure_rate=0)
+    logger = logging.getLogger('therminator')
+    args = types.SimpleNamespace(dry_run=False)
+    try:
+        with StandInServer() as server:
+            config = {
+                'api': {'endpoint': server.url, 'api_key': 'bench'},
+                'internal': {'sensor': 'pi', 'options': {}},
+                'temperature': {'sensor': 'ds18b20', 'options': {}},
+                'light': {
+                    'sensor': 'photoresistor',
+                    'options': {
+                        'pins': [22, 17],
+                        'capacitance': 0.1,
+                        'resistance': 1000,
+                    },
+                },
+            }
+
+            def cycle():
+                payload = measure(config, NullLED(), logger)
+                post(payload, config, args)
+
+            return summarize(timed(cycle, n))
+    finally:
+        hardware.use('rpi')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks')
+    parser.add_argument(
+        '-n',
+        type=int,
+        default=200,
+        help='Number of iterations of each benchmark (default: 200)',
+    )
+    parser.add_argument(
+        '-k', '--only',
+        metavar='NAME',
+        action='append',
+        help='Only run benchmarks whose name starts with NAME',
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help='Write results to FILE as JSON',
+    )
+    parser.add_argument(
+        '-c', '--compare',
+        metavar='FILE',
+        help='Compare results with an earlier run saved with --output',
+    )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    therminator_logger = logging.getLogger('therminator')
+    therminator_logger.addHandler(logging.NullHandler())
+    therminator_logger.propagate = False
+
+    # The full cycle is much slower than the rest, so it gets fewer runs.
+    iterations = collections.defaultdict(lambda: args.n, cycle=max(args.n // 20, 1))
+
+    results = collections.OrderedDict()
+    for name, func in BENCHMARKS.items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        results[name] = func(iterations[name])
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print('{:<30} {:>12} {:>12} {:>12}'.format('benchmark', 'median', 'p95', 'vs. baseline'))
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            change = '{:.2f}x'.format(baseline[name]['median'] / result['median'])
+        print('{:<30} {:>10.1f}us {:>10.1f}us {:>12}'.format(
+            name, result['median'] * 10**6, result['p95'] * 10**6, change))
+
+    if args.output:
+        report = dict(
+            version=therminator.__version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            timestamp=datetime.utcnow().isoformat(),
+            results=results,
+        )
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
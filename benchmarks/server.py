@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for the therminator API server."""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import random
+from socketserver import ThreadingMixIn
+import threading
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """HTTP server that accepts any POST, failing a fraction of them.
+
+    Keyword arguments:
+    failure_rate -- fraction of requests answered with 503 (default: 0)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, failure_rate=0):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/v1/sensors/bench'.format(self.server_port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, Nagle's
+    # algorithm delays the body by ~40ms on a kept-alive connection.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        if random.random() < self.server.failure_rate:
+            self._respond(503, b'{"error":"injected failure"}')
+        else:
+            self._respond(201, b'{}')
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -2,79 +2,414 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import collections
 from datetime import datetime
 import logging
 import logging.config
 import os
+import signal
+import sqlite3
+import threading
 import time
 import yaml
-from RPi import GPIO
 
 from . import api
+from . import hardware
+from . import metrics
+from .aggregate import Aggregator
+from .cache import Cache
+from .health import Health
+from .history import History
 from .led import LED, NullLED
-from .sensors import *
+from .scheduler import Scheduler
+from .spool import Spool
+from .uploader import Uploader
 from .utils import *
 
+CYCLE_SECONDS = metrics.histogram(
+    'therminator_cycle_seconds',
+    'Time taken to read all sensors in a cycle',
+)
+
 def main():
     args = parse_args()
     config = load_config(args.config)
     logger = setup_logger(config['logging'], debug=args.debug)
+    load_channels(config)  # Fail early on an invalid channel configuration
+    check_batching(config)
+
+    if args.simulate:
+        hardware.use('simulated', **config.get('simulate', {}))
 
-    lock(logger=logger)
-    GPIO.setmode(GPIO.BCM)
+    if args.daemon:
+        daemon(config, args, logger)
+    else:
+        run(config, args, logger)
+
+def run(config, args, logger):
+    """Take a single set of readings and post them to the API."""
+    import_metrics(config, logger)
+    if not lock(logger=logger):
+        return
+    setup_gpio()
 
     try:
-        if 'led' in config:
-            led = LED(**config['led'])
-        else:
-            led = NullLED()
-
-        logger.debug('Starting therminator run')
-        led.on()
-        t1 = time.time()
-
-        timestamp = datetime.utcnow()
-
-        sensor = config['internal']['sensor']
-        kwargs = config['internal']['options']
-        int_temp = lookup_sensor(sensor).read(**kwargs)
-
-        sensor = config['temperature']['sensor']
-        kwargs = config['temperature']['options']
-        ext_temp, humidity = lookup_sensor(sensor).read(**kwargs)
-
-        if 'light' in config:
-            sensor = config['light']['sensor']
-            kwargs = config['light']['options']
-            resistance = lookup_sensor(sensor).read(**kwargs)
-        else:
-            resistance = 0
-
-        t2 = time.time()
-        led.off()
-
-        log_message = 'timestamp={}'.format(timestamp.isoformat())
-        log_message += ' int_temp={:f}C'.format(int_temp)
-        log_message += ' ext_temp={:f}C'.format(ext_temp)
-        if humidity is not None:
-            log_message += ' humidity={:f}%'.format(humidity)
-        log_message += ' resistance={:f}ohms'.format(resistance)
-        log_message += ' runtime={:.1f}s'.format(t2-t1)
-        logger.info(log_message)
+        led = setup_led(config)
+        payload = measure(config, led, logger, setup_health(config))
     finally:
-        GPIO.cleanup()
+        cleanup_gpio()
         unlock(logger)
 
-    if not args.dry_run and 'api' in config:
-        payload = dict(
-            timestamp=timestamp.isoformat(),
-            int_temp=int_temp,
-            ext_temp=ext_temp,
-            humidity=humidity,
-            resistance=resistance,
+    share(payload, setup_cache(config), logger)
+    archive(payload, setup_history(config), logger)
+    post(payload, config, args, setup_spool(config))
+    export_metrics(config, logger)
+    logger.debug('Completed therminator run')
+
+def daemon(config, args, logger):
+    """Take readings and post them to the API every args.interval seconds.
+
+    GPIO and sensor state are set up once and held for the life of the
+    process. The lock is only held while the sensors are being read, so other
+    clients (e.g., the UI) can still take readings between cycles. Readings
+    are posted by a background upload worker, so a slow or unreachable server
+    never delays the next cycle.
+
+    If any channel has its own interval, the sensors are instead
+    sampled on independent schedules (see schedule()). If aggregation is
+    configured, readings are summarized and posted every
+    config['aggregate']['interval'] seconds (see submit()).
+    """
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        logger.info('Received signal %s: shutting down', signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    logger.info('Starting therminator daemon (interval=%ss)', args.interval)
+    serve_metrics(config)
+    setup_gpio()
+    uploader = None
+    try:
+        led = setup_led(config)
+        uploader, send = setup_uploader(config, args, setup_spool(config))
+        history = setup_history(config)
+        aggregator = setup_aggregator(config)
+        cache = setup_cache(config)
+        health = setup_health(config)
+        if any('interval' in channel for channel in load_channels(config)):
+            schedule(config, args, logger, led, send, history, aggregator, cache, health, stop)
+            return
+        next_run = time.monotonic()
+        while not stop.is_set():
+            try:
+                if lock(logger=logger):
+                    try:
+                        payload = measure(config, led, logger, health)
+                    finally:
+                        unlock(logger)
+                    share(payload, cache, logger)
+                    archive(payload, history, logger)
+                    submit(payload, send, aggregator)
+                else:
+                    logger.warning('Skipping cycle: sensors are locked by another process')
+            except Exception:
+                logger.exception('Therminator cycle failed')
+            export_metrics(config, logger)
+
+            next_run += args.interval
+            delay = next_run - time.monotonic()
+            if delay < 0:
+                skipped = int(-delay // args.interval) + 1
+                logger.warning('Cycle overran interval: skipping %s run(s)', skipped)
+                next_run += skipped * args.interval
+                delay = next_run - time.monotonic()
+            stop.wait(delay)
+        flush(send, aggregator)
+    finally:
+        cleanup_gpio()
+        if uploader is not None:
+            uploader.stop()
+        logger.info('Therminator daemon stopped')
+
+def schedule(config, args, logger, led, send, history, aggregator, cache, health, stop):
+    """Sample each sensor on its own interval until stop is set.
+
+    Each channel is read every channel['interval'] seconds (default:
+    args.interval), and the latest reading from every channel is posted
+    every args.interval seconds by passing it to send. Cheap sensors can
+    therefore be sampled often without waiting on slow ones. Since sensors are read at
+    arbitrary times, the lock is held for as long as the daemon runs. As in
+    read_sensors(), the DHT22 and photoresistor are never read at the same
+    time, since the DHT22 holds the GIL and would skew the photoresistor's
+    timing; read_sensor() serializes them.
+    """
+    channels = load_channels(config)
+    latest = {}
+    active = []
+    active_lock = threading.Lock()
+
+    def sample(channel):
+        with active_lock:
+            active.append(channel['name'])
+            led.on()
+        try:
+            latest[channel['name']] = read_sensor(channel, logger, health)
+        finally:
+            with active_lock:
+                active.remove(channel['name'])
+                if not active:
+                    led.off()
+
+    def upload():
+        readings = dict(latest)
+        try:
+            payload = report(datetime.utcnow(), readings, config, logger)
+            share(payload, cache, logger)
+            archive(payload, history, logger)
+            submit(payload, send, aggregator)
+        finally:
+            export_metrics(config, logger)
+
+    scheduler = Scheduler()
+    for channel in channels:
+        scheduler.every(
+            channel.get('interval', args.interval),
+            lambda channel=channel: sample(channel),
+            name=channel['name'],
+            immediate=True,
         )
-        api.write(payload, **config['api'])
+    scheduler.every(args.interval, upload, name='upload')
 
-    logger.debug('Completed therminator run')
+    while not lock(logger=logger):
+        if stop.is_set():
+            return
+    try:
+        scheduler.run(stop)
+    finally:
+        unlock(logger)
+    flush(send, aggregator)
+
+def setup_led(config):
+    if 'led' in config:
+        return LED(**config['led'])
+    else:
+        return NullLED()
+
+def setup_spool(config):
+    if 'spool' in config:
+        return Spool(**config['spool'])
+
+def check_batching(config):
+    """Raise ValueError if the spool posts batches without a batch endpoint.
+
+    The endpoint for single readings does not accept batches, so posting them
+    there would only have them rejected.
+    """
+    batch_size = config.get('spool', {}).get('batch_size', 1)
+    if batch_size > 1 and 'batch_endpoint' not in config.get('api', {}):
+        raise ValueError('Spool batch_size is {} but api has no batch_endpoint'.format(batch_size))
+
+def setup_uploader(config, args, spool):
+    """Start a worker that posts readings in the background.
+
+    Returns the Uploader and a callable that queues a payload to be posted.
+    If a spool is configured, the callable pushes the payload to it before
+    returning, so the reading survives a crash and is never dropped from a
+    full queue; the worker then only drains the spool. Since nothing waits on
+    the worker, it retries with backoff and honors Retry-After.
+    """
+    uploader = Uploader(
+        lambda payload: deliver(payload, config, spool, backoff=True),
+        **config.get('upload', {})
+    ).start()
+
+    def send(payload):
+        if args.dry_run or 'api' not in config:
+            return
+        if spool is None:
+            uploader.put(payload)
+            return
+        spool.push(payload)
+        # A drain that is already queued will post this reading too.
+        if not len(uploader):
+            uploader.put(None)
+
+    return uploader, send
+
+def setup_aggregator(config):
+    if 'aggregate' in config:
+        return Aggregator(**config['aggregate'])
+
+def setup_health(config):
+    if 'health' in config:
+        return Health(**config['health'])
+
+def setup_cache(config):
+    if 'cache' in config:
+        return Cache(**config['cache'])
+
+def share(payload, cache, logger):
+    """Save payload as the latest reading, if a cache is configured."""
+    if cache is None:
+        return
+    try:
+        cache.save(payload)
+    except OSError as e:
+        logger.warning('Failed to cache reading: %r', e)
+
+def setup_history(config):
+    if 'history' in config:
+        return History(**config['history'])
+
+def archive(payload, history, logger):
+    """Record payload in the local history, if one is configured."""
+    if history is None:
+        return
+    try:
+        history.record(payload)
+    except sqlite3.Error as e:
+        logger.warning('Failed to record reading in history: %r', e)
+
+def serve_metrics(config):
+    """Serve metrics over HTTP if a metrics port is configured."""
+    options = config.get('metrics', {})
+    if 'port' in options:
+        metrics.serve(options['port'], options.get('address', '127.0.0.1'))
+
+def import_metrics(config, logger):
+    """Carry counters over from the configured textfile, if any.
+
+    Each run from cron is a new process, so without this every counter in
+    the textfile would only count the latest run.
+    """
+    file = config.get('metrics', {}).get('textfile')
+    if file is None:
+        return
+    try:
+        metrics.load_textfile(file)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning('Failed to load metrics from %s: %r', file, e)
+
+def export_metrics(config, logger):
+    """Write metrics to the configured textfile, if any."""
+    file = config.get('metrics', {}).get('textfile')
+    if file is None:
+        return
+    try:
+        metrics.write_textfile(file)
+    except OSError as e:
+        logger.warning('Failed to write metrics to %s: %r', file, e)
+
+def measure(config, led, logger, health=None):
+    """Read the configured sensors and return the readings as a payload."""
+    logger.debug('Starting therminator run')
+    led.on()
+    t1 = time.time()
+
+    timestamp = datetime.utcnow()
+    with CYCLE_SECONDS.time():
+        readings = read_sensors(load_channels(config), logger, health=health)
+
+    t2 = time.time()
+    led.off()
+
+    return report(timestamp, readings, config, logger, runtime=t2-t1)
+
+def report(timestamp, readings, config, logger, runtime=None):
+    """Log the readings of each channel and return them as a payload."""
+    if not any(reading is not None for reading in readings.values()):
+        raise RuntimeError('All sensors failed to return readings')
+
+    payload = collections.OrderedDict(timestamp=timestamp.isoformat())
+    payload.update(to_fields(load_channels(config), readings))
+    # Configs that predate channels always posted a resistance.
+    if 'channels' not in config and 'light' not in config:
+        payload['resistance'] = 0
+
+    log_message = 'timestamp=%s'
+    log_args = [payload['timestamp']]
+    for field, value in payload.items():
+        if field != 'timestamp':
+            log_message += ' %s=%s'
+            log_args.extend([field, _format(value)])
+    if runtime is not None:
+        log_message += ' runtime=%.1fs'
+        log_args.append(runtime)
+    logger.info(log_message, *log_args)
+
+    return payload
+
+def _format(value):
+    if value is None:
+        return 'NA'
+    return '{:f}'.format(value)
+
+def post(payload, config, args, spool=None):
+    """Post payload to the API.
+
+    If a spool is configured, the payload is written to it first and then the
+    spool is drained, so readings that could not be posted in earlier runs
+    are delivered in order once the server is reachable again. If the spool
+    has a batch_size greater than 1, backlogged readings are posted in
+    batches.
+    """
+    if args.dry_run or 'api' not in config:
+        return
+    if spool is not None:
+        spool.push(payload)
+    deliver(payload, config, spool)
+
+def deliver(payload, config, spool=None, **options):
+    """Post payload, or drain spool if one is configured.
+
+    Keyword arguments:
+    payload -- the readings to post (ignored if spool is given, since it
+               must already have been pushed to it)
+    config -- the client configuration
+    spool -- the Spool to drain (default: None)
+
+    Any other keyword arguments override config['api'] (e.g., backoff).
+    """
+    options = dict(config['api'], **options)
+    if spool is None:
+        api.write(payload, **options)
+    elif spool.batch_size > 1:
+        spool.drain(lambda readings: api.write_batch(readings, **options))
+    else:
+        spool.drain(lambda readings: api.write(readings[0], **options))
+
+def submit(payload, send, aggregator=None):
+    """Send payload, or add it to aggregator and send summaries when due.
+
+    Keyword arguments:
+    payload -- the readings to post
+    send -- callable that posts a payload (e.g., Uploader.put)
+    aggregator -- an Aggregator to summarize readings with (default: None)
+
+    With an aggregator, each interval's readings are posted as a single
+    payload whose fields are their means, with the count, min, max, mean and
+    last value of each field under 'summary'.
+    """
+    if aggregator is None:
+        send(payload)
+        return
+    aggregator.add(payload)
+    if aggregator.due():
+        flush(send, aggregator)
+
+def flush(send, aggregator):
+    """Send the summary of any readings left in aggregator."""
+    if aggregator is None:
+        return
+    summary = aggregator.flush()
+    if summary is not None:
+        send(summary)
 
-main()
+if __name__ == '__main__':
+    main()
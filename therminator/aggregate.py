@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+
+class Aggregator:
+    """Summarizes readings taken over an interval into one payload.
+
+    Readings are added as they are taken, and flush() returns a payload in
+    which each field is the mean of its readings over the interval, so the
+    server can treat it like a single reading. The payload also has a
+    summary of each field, with its count, min, max, mean and last value.
+    """
+
+    def __init__(self, interval):
+        """
+        Keyword arguments:
+        interval -- seconds over which to summarize readings
+        """
+        self.interval = interval
+        self.started = None
+        self._fields = collections.OrderedDict()
+        self._timestamp = None
+        self._lock = threading.Lock()
+
+    def add(self, payload):
+        """Add the readings in payload to the current interval."""
+        with self._lock:
+            if self.started is None:
+                self.started = time.monotonic()
+            self._timestamp = payload['timestamp']
+            for field, value in payload.items():
+                if field == 'timestamp':
+                    continue
+                stats = self._fields.setdefault(field, _Stats())
+                if value is not None:
+                    stats.add(value)
+
+    def due(self):
+        """Return True once the current interval has ended."""
+        with self._lock:
+            return self.started is not None \
+                and time.monotonic() - self.started >= self.interval
+
+    def flush(self):
+        """Return the summary of the current interval and start a new one.
+
+        Returns None if no readings have been added since the last flush.
+        """
+        with self._lock:
+            if self._timestamp is None:
+                return None
+            payload = collections.OrderedDict(timestamp=self._timestamp)
+            summary = collections.OrderedDict()
+            for field, stats in self._fields.items():
+                payload[field] = stats.mean()
+                if stats.count > 0:
+                    summary[field] = stats.summary()
+            payload['summary'] = summary
+            if self.started is not None:
+                # Keep intervals back to back, so readings are not counted
+                # towards the next interval late.
+                elapsed = time.monotonic() - self.started
+                self.started += self.interval * max(int(elapsed // self.interval), 1)
+            self._fields = collections.OrderedDict()
+            self._timestamp = None
+            return payload
+
+
+class _Stats:
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sum += value
+        self.last = value
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def summary(self):
+        return dict(
+            count=self.count,
+            min=self.min,
+            max=self.max,
+            mean=self.mean(),
+            last=self.last,
+        )
@@ -1,45 +1,333 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import gzip
 import json
 import logging
+import random
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import threading
 import time
 
-def write(data, endpoint, api_key, timeout=30, retries=10):
+from . import metrics
+
+_clients = {}
+_local = threading.local()
+
+# Statuses with which the server refuses a batch as a whole rather than the
+# readings in it (e.g., a wrong batch_endpoint, or a server that does not
+# accept gzip-compressed batches).
+BATCH_REJECTIONS = (404, 405, 415)
+
+UPLOAD_SECONDS = metrics.histogram(
+    'therminator_upload_seconds',
+    'Time taken by each request to the API server',
+)
+UPLOAD_ATTEMPTS = metrics.histogram(
+    'therminator_upload_attempts',
+    'Attempts needed per upload',
+    buckets=metrics.COUNT_BUCKETS,
+)
+UPLOAD_RETRIES = metrics.counter(
+    'therminator_upload_retries_total',
+    'Requests to the API server that were retried',
+)
+UPLOAD_FAILURES = metrics.counter(
+    'therminator_upload_failures_total',
+    'Uploads abandoned after exhausting their attempts',
+)
+
+def write(data, endpoint, api_key, **kwargs):
     """Post data to API server.
 
     Keyword arguments:
     data -- dictionary of sensor readings to be posted
     endpoint -- URL of API endpoint for this sensor's readings
     api_key -- API account secret key
+
+    Any other keyword arguments are passed to Client. The client is cached, so
+    a long-running process reuses the same connection on every call.
+    """
+    return client(endpoint, api_key, **kwargs).write(data)
+
+def write_batch(readings, endpoint, api_key, **kwargs):
+    """Post many readings to API server in a single gzipped request.
+
+    Keyword arguments:
+    readings -- list of dictionaries of sensor readings to be posted
+    endpoint -- URL of API endpoint for this sensor's readings
+    api_key -- API account secret key
+
+    Any other keyword arguments are passed to Client.
     """
-    logger = logging.getLogger(__name__)
-    logger.debug('Started posting data to {}'.format(endpoint))
+    return client(endpoint, api_key, **kwargs).write_batch(readings)
+
+def client(endpoint, api_key, **kwargs):
+    """Return the shared Client for the given endpoint and API key."""
+    key = (endpoint, api_key, tuple(sorted(kwargs.items())))
+    if key not in _clients:
+        _clients[key] = Client(endpoint, api_key, **kwargs)
+    return _clients[key]
+
+
+class Client:
+    """Connection to the API server.
+
+    The client owns a requests.Session with a pooled, keep-alive connection to
+    the API server, so the TCP and TLS handshakes are paid once rather than on
+    every post and retry. The timings of the most recent request are kept in
+    the timings attribute.
+    """
+
+    def __init__(self, endpoint, api_key, timeout=30, retries=10, pool_size=2,
+                 batch_endpoint=None, delay=2, backoff=False, max_delay=300):
+        """
+        Keyword arguments:
+        endpoint -- URL of API endpoint for this sensor's readings
+        api_key -- API account secret key
+        timeout -- number of seconds to wait for the server (default: 30)
+        retries -- number of attempts before giving up (default: 10)
+        pool_size -- maximum number of connections to keep open (default: 2)
+        batch_endpoint -- URL of API endpoint for batches of readings
+                          (default: None, so batches cannot be posted)
+        delay -- number of seconds to wait between attempts, or after the
+                 first failed attempt if backoff is set (default: 2)
+        backoff -- whether to double the wait (with random jitter) after each
+                   further failure and honor Retry-After from the server,
+                   for posts that nothing is waiting on (default: False)
+        max_delay -- maximum number of seconds to wait between attempts
+                     with backoff, including any the server asks for with
+                     Retry-After (default: 300)
+        """
+        self.endpoint = endpoint
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.batch_endpoint = batch_endpoint
+        self.timeout = timeout
+        self.retries = retries
+        self.timings = {}
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': api_key,
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+        adapter = _TimingAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def write(self, data):
+        """Post data to API server.
+
+        Keyword arguments:
+        data -- dictionary of sensor readings to be posted
+
+        Returns True once the server has dealt with the data, i.e., it either
+        accepted it or rejected it as invalid, and False if it could not be
+        delivered and should be retried later.
+        """
+        body = json.dumps(data).encode('utf-8')
+        return self._deliver(self.endpoint, body, {})
+
+    def write_batch(self, readings):
+        """Post many readings to API server in a single request.
+
+        Keyword arguments:
+        readings -- list of dictionaries of sensor readings to be posted
+
+        The readings are sent as a gzip-compressed JSON object of the form
+        {"readings": [...]}. Returns True or False as for write().
+
+        If the server rejects the batch as a whole (see BATCH_REJECTIONS),
+        e.g., because batch_endpoint is wrong, nothing is dropped and False is
+        returned. If it rejects the batch for any other reason, the readings
+        are posted one by one with write(), so only the readings the server
+        refuses are dropped and one bad reading cannot hold up the rest. (If
+        one of those posts fails, the batch is retried in full, so the server
+        may see some readings twice.)
+        """
+        if self.batch_endpoint is None:
+            raise ValueError('No batch_endpoint configured for batches of readings')
+        body = json.dumps({'readings': readings}, separators=(',', ':'))
+        body = gzip.compress(body.encode('utf-8'))
+        logger = logging.getLogger(__name__)
+        logger.debug('Compressed batch of %s reading(s) to %s bytes', len(readings), len(body))
+        return self._deliver(
+            self.batch_endpoint, body, {'Content-Encoding': 'gzip'},
+            rejected=lambda response: self._rejected_batch(readings, response))
+
+    def _rejected_batch(self, readings, response):
+        logger = logging.getLogger(__name__)
+        if response.status_code in BATCH_REJECTIONS:
+            logger.error('Batch endpoint refused batch (kept for retry): %s', response.reason)
+            UPLOAD_FAILURES.inc()
+            return False
+        logger.warning('Posting %s rejected reading(s) one by one', len(readings))
+        for data in readings:
+            if not self.write(data):
+                return False
+        return True
+
+    def _deliver(self, url, body, headers, rejected=None):
+        """Post body to url, retrying failures.
 
-    for i in range(1, retries+1):
-        logger.debug('Attempt #{}'.format(i))
+        If the server rejects the data, returns True (the data is dropped)
+        or, if given, the result of rejected(response).
+        """
+        logger = logging.getLogger(__name__)
+        logger.debug('Started posting data to %s', url)
+
+        for i in range(1, self.retries+1):
+            logger.debug('Attempt #%s', i)
+            retry_after = None
+            try:
+                response = self._post(url, body, headers)
+                if response.ok:
+                    logger.info('Data posted to server: %s', response.reason)
+                    logger.debug(
+                        'Finished posting data (%.1fs): connect=%.3fs '
+                        'tls=%.3fs transfer=%.3fs',
+                        self.timings['total'],
+                        self.timings['connect'],
+                        self.timings['tls'],
+                        self.timings['transfer'],
+                    )
+                    UPLOAD_ATTEMPTS.observe(i)
+                    return True
+                reason = response.reason
+                message = _error_message(response)
+                if _rejected(response):
+                    logger.error('Server rejected data: %s: %s', reason, message)
+                    UPLOAD_ATTEMPTS.observe(i)
+                    return True if rejected is None else rejected(response)
+                logger.warning('Server failure: %s: %s', reason, message)
+                retry_after = _retry_after(response)
+            except requests.exceptions.RequestException as e:
+                logger.warning('Network failure: %r', e)
+            if i < self.retries:
+                UPLOAD_RETRIES.inc()
+                wait = self._backoff(i, retry_after)
+                logger.debug('Retrying in %.1fs', wait)
+                time.sleep(wait)
+        logger.error('Giving up after %s attempts', self.retries)
+        UPLOAD_ATTEMPTS.observe(self.retries)
+        UPLOAD_FAILURES.inc()
+        return False
+
+    def _backoff(self, attempt, retry_after=None):
+        """Return the number of seconds to wait after a failed attempt.
+
+        Without backoff, the wait is always delay. With backoff, waits are
+        exponential with "equal jitter": half of each wait is random, so
+        clients that failed together do not retry in lockstep.
+        """
+        if not self.backoff:
+            return self.delay
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        wait = min(self.delay * 2**(attempt-1), self.max_delay)
+        return wait / 2 + random.uniform(0, wait / 2)
+
+    def close(self):
+        """Close any pooled connections."""
+        self.session.close()
+
+    def _post(self, url, body, headers):
+        _local.timings = {}
+        t1 = time.monotonic()
         try:
-            response = requests.post(
-                endpoint,
-                headers={
-                    'Authorization': api_key,
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                },
-                data=json.dumps(data),
-                timeout=timeout,
+            return self.session.post(url, data=body, headers=headers, timeout=self.timeout)
+        finally:
+            total = time.monotonic() - t1
+            UPLOAD_SECONDS.observe(total)
+            connect = _local.timings.get('connect', 0.0)
+            tls = _local.timings.get('tls', 0.0)
+            self.timings = dict(
+                connect=connect,
+                tls=tls,
+                transfer=total - connect - tls,
+                total=total,
+                reused='connect' not in _local.timings,
             )
-            if response.ok:
-                elapsed_time = response.elapsed.total_seconds()
-                logger.info('Data posted to server: {}'.format(response.reason))
-                logger.debug('Finished posting data ({:.1f}s)'.format(elapsed_time))
-            else:
-                reason = response.reason
-                message = response.json().get('error')
-                logger.warning('Server failure: {}: {}'.format(reason, message))
-            return
-        except requests.exceptions.RequestException as e:
-            logger.warning('Network failure: {!r}'.format(e))
-            time.sleep(2)
-    logger.error('Giving up after {} attempts'.format(retries))
+
+
+def _rejected(response):
+    """Return True if retrying the request can never succeed.
+
+    Client errors mean the data itself is bad, except for authentication and
+    rate-limiting errors, which may clear up once the problem is fixed.
+    """
+    return 400 <= response.status_code < 500 and \
+        response.status_code not in (401, 403, 408, 429)
+
+def _retry_after(response):
+    """Return the seconds to wait given by response's Retry-After header."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+
+def _error_message(response):
+    try:
+        return response.json().get('error')
+    except ValueError:
+        return response.text
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        t1 = time.monotonic()
+        try:
+            return super()._new_conn()
+        finally:
+            _local.timings['connect'] = time.monotonic() - t1
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        t1 = time.monotonic()
+        try:
+            return super()._new_conn()
+        finally:
+            _local.timings['connect'] = time.monotonic() - t1
+
+    def connect(self):
+        t1 = time.monotonic()
+        super().connect()
+        elapsed = time.monotonic() - t1
+        _local.timings['tls'] = elapsed - _local.timings.get('connect', 0.0)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record connect and TLS handshake times."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
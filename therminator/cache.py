@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+class Cache:
+    """The latest reading, shared between processes through a file.
+
+    Each reading is written to a temporary file that is then renamed over
+    the cache, so readers always see a complete reading. By default the
+    cache lives in /dev/shm, so it costs no writes to the SD card. Clients
+    such as the UI can show the latest reading without touching the
+    hardware or waiting for the lock.
+    """
+
+    def __init__(self, file='/dev/shm/therminator.json', max_age=60):
+        """
+        Keyword arguments:
+        file -- path to the cache file (default: /dev/shm/therminator.json)
+        max_age -- seconds for which a cached reading is fresh (default: 60)
+        """
+        self.file = file
+        self.max_age = max_age
+
+    def save(self, payload):
+        """Replace the cached reading with payload."""
+        tmp = '{}.{}.tmp'.format(self.file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(payload, f)
+        os.replace(tmp, self.file)
+
+    def load(self, max_age=None):
+        """Return the cached reading, or None if it is missing or stale.
+
+        Keyword arguments:
+        max_age -- seconds for which a cached reading is fresh (default:
+                   self.max_age)
+        """
+        if max_age is None:
+            max_age = self.max_age
+        try:
+            with open(self.file) as f:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                if age > max_age:
+                    logger.debug('Cached reading is stale (%.0fs old)', age)
+                    return None
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning('Failed to load cached reading: %r', e)
+            return None
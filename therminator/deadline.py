@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+class Deadline:
+    """A point in time after which a sensor read should give up.
+
+    Unlike a SIGALRM-based timeout, a deadline works on any thread and does
+    not take over the process-wide alarm. Read loops check it cooperatively by
+    calling check() and sleeping with sleep().
+    """
+
+    def __init__(self, seconds, message='Timed out'):
+        """
+        Keyword arguments:
+        seconds -- number of seconds from now until the deadline, or None for
+                   a deadline that never expires
+        message -- message of the TimeoutError raised once expired
+        """
+        self.message = message
+        if seconds is None:
+            self.expires = None
+        else:
+            self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        """Return the number of seconds left, or None if there is no limit."""
+        if self.expires is None:
+            return None
+        return max(self.expires - time.monotonic(), 0)
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def check(self):
+        """Raise TimeoutError if the deadline has passed."""
+        if self.expired():
+            raise TimeoutError(self.message)
+
+    def sleep(self, seconds):
+        """Sleep for up to seconds, then raise TimeoutError if expired."""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        time.sleep(seconds)
+        self.check()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Access to the hardware the sensors are attached to.
+
+Sensors and the LED get the GPIO and DHT libraries and the paths of kernel
+interface files from this module rather than importing RPi.GPIO and
+Adafruit_DHT directly. By default these are the real thing. Calling
+use('simulated') swaps in the simulations in therminator.simulator, so the
+whole client can run on a machine that is not a Raspberry Pi.
+"""
+
+_backend = None
+
+def use(name, **options):
+    """Select the hardware backend, 'rpi' or 'simulated'.
+
+    Keyword arguments are passed to the backend.
+    """
+    global _backend
+    if name == 'rpi':
+        _backend = RPiBackend(**options)
+    elif name == 'simulated':
+        from .simulator import SimulatedBackend
+        _backend = SimulatedBackend(**options)
+    else:
+        raise ValueError('Unknown hardware backend: {}'.format(name))
+    return _backend
+
+def backend():
+    if _backend is None:
+        use('rpi')
+    return _backend
+
+def gpio():
+    """Return the GPIO module (RPi.GPIO or a simulation)."""
+    return backend().gpio()
+
+def dht():
+    """Return the DHT module (Adafruit_DHT or a simulation)."""
+    return backend().dht()
+
+def path(file):
+    """Return the path at which to find the kernel interface file."""
+    return backend().path(file)
+
+
+class RPiBackend:
+    def gpio(self):
+        from RPi import GPIO
+        return GPIO
+
+    def dht(self):
+        import Adafruit_DHT
+        return Adafruit_DHT
+
+    def path(self, file):
+        return file
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE = metrics.gauge(
+    'therminator_sensor_available',
+    'Whether each sensor is being read (1) or skipped after failures (0)',
+    labels=('channel',),
+)
+
+class Health:
+    """Circuit breaker for each sensor.
+
+    Once a sensor has failed threshold times in a row, it is skipped (and
+    its reading reported as unavailable) for backoff seconds. After that, a
+    single read is let through as a probe: if it succeeds, the sensor is
+    read normally again, and if it fails, it is skipped for twice as long,
+    up to max_backoff seconds. A dead sensor therefore costs almost nothing
+    per cycle instead of its full timeout.
+
+    If file is given, the state is saved there after every change, so it
+    persists across runs of the client.
+    """
+
+    def __init__(self, file=None, threshold=3, backoff=60, max_backoff=3600):
+        """
+        Keyword arguments:
+        file -- path to a JSON file in which to keep the state (default: keep
+                it in memory only)
+        threshold -- consecutive failures after which a sensor is skipped
+                     (default: 3)
+        backoff -- seconds to skip a sensor after threshold failures
+                   (default: 60)
+        max_backoff -- maximum seconds to skip a sensor (default: 3600)
+        """
+        self.file = file
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._sensors = self._load()
+
+    def allow(self, name):
+        """Return True if sensor name should be read now."""
+        with self._lock:
+            state = self._sensors.get(name)
+            if state is None or time.time() >= state['retry_at']:
+                return True
+        logger.debug('Skipping %s sensor for another %.0fs', name, state['retry_at'] - time.time())
+        return False
+
+    def state(self, name):
+        """Return 'closed' (healthy), 'open' (skipped) or 'half-open'."""
+        with self._lock:
+            state = self._sensors.get(name)
+            if state is None or state['failures'] < self.threshold:
+                return 'closed'
+            return 'open' if time.time() < state['retry_at'] else 'half-open'
+
+    def success(self, name):
+        """Record a successful read of sensor name."""
+        with self._lock:
+            state = self._sensors.get(name)
+            if state is not None and state['failures'] >= self.threshold:
+                logger.info('%s sensor recovered after %d failure(s)', name, state['failures'])
+            changed = state is None or state['failures'] > 0
+            self._sensors[name] = dict(
+                failures=0,
+                last_success=time.time(),
+                retry_at=0,
+            )
+            AVAILABLE.set(1, channel=name)
+            if changed:
+                self._save()
+
+    def failure(self, name):
+        """Record a failed read of sensor name."""
+        with self._lock:
+            state = self._sensors.setdefault(
+                name, dict(failures=0, last_success=None, retry_at=0))
+            state['failures'] += 1
+            if state['failures'] >= self.threshold:
+                backoff = min(
+                    self.backoff * 2**(state['failures'] - self.threshold),
+                    self.max_backoff,
+                )
+                state['retry_at'] = time.time() + backoff
+                AVAILABLE.set(0, channel=name)
+                logger.warning(
+                    '%s sensor failed %d time(s) in a row: skipping it for %.0fs',
+                    name,
+                    state['failures'],
+                    backoff,
+                )
+            self._save()
+
+    def _load(self):
+        if self.file is None:
+            return {}
+        try:
+            with open(self.file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning('Failed to load sensor health from %s: %r', self.file, e)
+            return {}
+
+    def _save(self):
+        if self.file is None:
+            return
+        tmp = '{}.{}.tmp'.format(self.file, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._sensors, f)
+            os.replace(tmp, self.file)
+        except OSError as e:
+            logger.warning('Failed to save sensor health to %s: %r', self.file, e)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Local time-series store of every reading.
+
+Raw readings are kept for a short time, and are rolled up as they arrive into
+per-minute, per-hour and per-day min/mean/max summaries that are kept for
+progressively longer. Old rows are pruned on every write, so the store stays
+a fixed size for a given sampling rate.
+
+To print recent history from the command line:
+
+    $ python3 -m therminator.history /var/tmp/therminator-history.db ext_temp --since 86400
+"""
+
+import calendar
+import collections
+from datetime import datetime
+import logging
+import numbers
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# Width (in seconds) of the buckets of each rollup tier, finest first.
+TIERS = collections.OrderedDict([
+    ('minute', 60),
+    ('hour', 3600),
+    ('day', 86400),
+])
+
+# Default seconds to keep raw readings and each tier.
+RETENTION = {
+    'raw': 86400,
+    'minute': 7 * 86400,
+    'hour': 365 * 86400,
+    'day': 10 * 365 * 86400,
+}
+
+class History:
+    """Time-series store of readings backed by a SQLite database."""
+
+    def __init__(self, path, retention=None):
+        """
+        Keyword arguments:
+        path -- path to the SQLite database file
+        retention -- seconds to keep 'raw' readings and each of the 'minute',
+                     'hour' and 'day' tiers (default: RETENTION)
+        """
+        self.path = path
+        self.retention = dict(RETENTION)
+        self.retention.update(retention or {})
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS samples ('
+            '  field TEXT NOT NULL,'
+            '  t REAL NOT NULL,'
+            '  value REAL NOT NULL,'
+            '  PRIMARY KEY (field, t)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS rollups ('
+            '  tier INTEGER NOT NULL,'
+            '  field TEXT NOT NULL,'
+            '  t INTEGER NOT NULL,'
+            '  count INTEGER NOT NULL,'
+            '  min REAL NOT NULL,'
+            '  max REAL NOT NULL,'
+            '  sum REAL NOT NULL,'
+            '  PRIMARY KEY (tier, field, t)'
+            ') WITHOUT ROWID'
+        )
+
+    def record(self, payload):
+        """Store every numeric field of payload at payload['timestamp']."""
+        t = _timestamp(payload['timestamp'])
+        values = [
+            (field, value) for field, value in sorted(payload.items())
+            if isinstance(value, numbers.Real) and not isinstance(value, bool)
+        ]
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            for field, value in values:
+                self._insert(field, t, float(value))
+                self._prune(field, t)
+
+    def _insert(self, field, t, value):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO samples (field, t, value) VALUES (?, ?, ?)',
+            (field, t, value),
+        )
+        for width in TIERS.values():
+            bucket = int(t // width * width)
+            self.conn.execute(
+                'INSERT OR IGNORE INTO rollups VALUES (?, ?, ?, 0, ?, ?, 0)',
+                (width, field, bucket, value, value),
+            )
+            self.conn.execute(
+                'UPDATE rollups'
+                ' SET count = count + 1, min = min(min, ?), max = max(max, ?), sum = sum + ?'
+                ' WHERE tier = ? AND field = ? AND t = ?',
+                (value, value, value, width, field, bucket),
+            )
+
+    def _prune(self, field, now):
+        self.conn.execute(
+            'DELETE FROM samples WHERE field = ? AND t < ?',
+            (field, now - self.retention['raw']),
+        )
+        for name, width in TIERS.items():
+            self.conn.execute(
+                'DELETE FROM rollups WHERE tier = ? AND field = ? AND t < ?',
+                (width, field, now - self.retention[name]),
+            )
+
+    def fields(self):
+        """Return the names of all fields in the store."""
+        rows = self.conn.execute('SELECT DISTINCT field FROM rollups ORDER BY field')
+        return [field for field, in rows]
+
+    def query(self, field, start=None, end=None, resolution=None):
+        """Return the history of field between start and end.
+
+        Keyword arguments:
+        field -- name of the field (e.g., 'ext_temp')
+        start -- Unix time of the earliest reading (default: all)
+        end -- Unix time of the latest reading (default: now)
+        resolution -- 'raw', 'minute', 'hour' or 'day' (default: the finest
+                      that is still retained at start)
+
+        Returns a list of (t, min, mean, max) tuples in order of time, where
+        t is the start of each bucket. Raw readings have min = mean = max.
+        """
+        if end is None:
+            end = time.time()
+        if resolution is None:
+            resolution = self._resolution(start, end)
+        if resolution == 'raw':
+            rows = self.conn.execute(
+                'SELECT t, value, value, value FROM samples'
+                ' WHERE field = ? AND t >= ? AND t <= ? ORDER BY t',
+                (field, start if start is not None else 0, end),
+            )
+        elif resolution in TIERS:
+            width = TIERS[resolution]
+            rows = self.conn.execute(
+                'SELECT t, min, sum / count, max FROM rollups'
+                ' WHERE tier = ? AND field = ? AND t >= ? AND t <= ? ORDER BY t',
+                (width, field, start // width * width if start is not None else 0, end),
+            )
+        else:
+            raise ValueError('Unknown resolution: {}'.format(resolution))
+        return rows.fetchall()
+
+    def _resolution(self, start, end):
+        if start is None:
+            return 'day'
+        for name in ['raw'] + list(TIERS):
+            if start >= end - self.retention[name]:
+                return name
+        return 'day'
+
+    def close(self):
+        self.conn.close()
+
+
+def _timestamp(value):
+    """Return value, a datetime or ISO 8601 string in UTC, as Unix time."""
+    if isinstance(value, str):
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+        value = datetime.strptime(value, fmt)
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 10**6
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path',
+                        help='Path to the history database')
+    parser.add_argument('field',
+                        nargs='?',
+                        help='Field to print (default: list the fields)')
+    parser.add_argument('-s', '--since',
+                        type=float,
+                        default=3600,
+                        help='Print this many seconds of history (default: 3600)')
+    parser.add_argument('-r', '--resolution',
+                        choices=['raw'] + list(TIERS),
+                        help='Resolution of the history (default: the finest available)')
+    args = parser.parse_args()
+
+    history = History(args.path)
+    if args.field is None:
+        for field in history.fields():
+            print(field)
+    else:
+        start = time.time() - args.since
+        for t, low, mean, high in history.query(args.field, start, resolution=args.resolution):
+            print('{} min={:f} mean={:f} max={:f}'.format(
+                datetime.utcfromtimestamp(t).isoformat(), low, mean, high))
@@ -1,25 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from RPi import GPIO
+from . import hardware
 
 class LED:
     def __init__(self, pin):
+        GPIO = hardware.gpio()
+        self.GPIO = GPIO
         self.pin = pin
         GPIO.setup(pin, GPIO.OUT)
         self.state = 'off'
 
     def on(self):
-        GPIO.output(self.pin, GPIO.HIGH)
+        self.GPIO.output(self.pin, self.GPIO.HIGH)
         self.state = 'on'
 
     def off(self):
-        GPIO.output(self.pin, GPIO.LOW)
+        self.GPIO.output(self.pin, self.GPIO.LOW)
         self.state = 'off'
 
 
 class NullLED:
-    def __init__(self, _):
+    def __init__(self, *_):
         pass
 
     def on(self):
@@ -33,6 +35,8 @@ if __name__ == '__main__':
     import argparse
     import time
 
+    GPIO = hardware.gpio()
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-p', '--pin',
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Counters, gauges and histograms in the Prometheus text format.
+
+Modules define their metrics at import time with counter(), gauge() and
+histogram(). The metrics can be written to a file for the node_exporter
+textfile collector with write_textfile(), or served over HTTP at /metrics
+with serve(). A process that only lives for one run can carry the counters
+and histograms of earlier runs over from the file with load_textfile().
+"""
+
+import collections
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import os
+import re
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Buckets (in seconds) for latency histograms.
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Buckets for histograms of attempt and sample counts.
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 15, 20, 50, 100)
+
+_metrics = {}
+_lock = threading.Lock()
+
+# Values loaded by load_textfile() for metrics that have not been registered
+# yet (e.g., those of sensor drivers that are imported lazily), by name.
+_carried = {}
+
+_SAMPLE = re.compile(r'^([A-Za-z_:][A-Za-z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def counter(name, help, labels=()):
+    """Return the counter called name, creating it if necessary."""
+    return _register(Counter, name, help, labels)
+
+def gauge(name, help, labels=()):
+    """Return the gauge called name, creating it if necessary."""
+    return _register(Gauge, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    """Return the histogram called name, creating it if necessary."""
+    return _register(Histogram, name, help, labels, buckets=buckets)
+
+def _register(cls, name, help, labels, **kwargs):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, help, labels, **kwargs)
+            if name in _carried:
+                _metrics[name].carry(_carried.pop(name))
+        return _metrics[name]
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    with _lock:
+        metrics = sorted(_metrics.values(), key=lambda metric: metric.name)
+    return ''.join(metric.render() for metric in metrics)
+
+def write_textfile(file):
+    """Atomically write all metrics to file."""
+    tmp = '{}.{}.tmp'.format(file, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.replace(tmp, file)
+
+def load_textfile(file):
+    """Add the counters and histograms in file to the current metrics.
+
+    file is one written by write_textfile(). A process that runs once (e.g.,
+    from cron) calls this before it writes its own metrics to the same file,
+    so counters keep counting across runs instead of restarting from 0 on
+    every run, which rate() would read as no increase. Gauges describe the
+    current run and are not carried over.
+    """
+    with open(file) as f:
+        lines = f.read().splitlines()
+    loaded = collections.defaultdict(dict)
+    types = {}
+    for line in lines:
+        if line.startswith('# TYPE '):
+            _, _, name, type = line.split()
+            types[name] = type
+            continue
+        match = _SAMPLE.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        labels = dict((k, _unescape(v)) for k, v in _LABEL.findall(labels or ''))
+        if types.get(name) == 'counter':
+            loaded[name][_pairs(labels)] = _parse_number(value)
+            continue
+        base, _, suffix = name.rpartition('_')
+        if types.get(base) != 'histogram':
+            continue
+        le = labels.pop('le', None)
+        state = loaded[base].setdefault(_pairs(labels), dict(buckets={}, sum=0, count=0))
+        if suffix == 'bucket' and le is not None and le != '+Inf':
+            state['buckets'][float(le)] = _parse_number(value)
+        elif suffix in ('sum', 'count'):
+            state[suffix] = _parse_number(value)
+    with _lock:
+        for name, values in loaded.items():
+            if name in _metrics:
+                _metrics[name].carry(values)
+            else:
+                _carried[name] = values
+
+def serve(port, address='127.0.0.1'):
+    """Serve metrics over HTTP at /metrics from a background thread."""
+    server = _MetricsServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info('Serving metrics at http://%s:%s/metrics', address, server.server_port)
+    return server
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('{} expects labels {}'.format(self.name, self.label_names))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [
+            '# HELP {} {}\n'.format(self.name, self.help),
+            '# TYPE {} {}\n'.format(self.name, self.type),
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return ''.join(lines)
+
+    def _render_value(self, key, value):
+        return ['{}{} {}\n'.format(self.name, self._format_labels(key), _number(value))]
+
+    def carry(self, values):
+        """Add values loaded by load_textfile() to the current values."""
+        with self._lock:
+            for pairs, value in values.items():
+                labels = dict(pairs)
+                if set(labels) != set(self.label_names):
+                    continue
+                self._carry(tuple(labels[name] for name in self.label_names), value)
+
+    def _carry(self, key, value):
+        pass
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _carry(self, key, value):
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts, _, _ = state = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            state[1] += 1
+            state[2] += value
+
+    def _carry(self, key, value):
+        if tuple(sorted(value['buckets'])) != self.buckets:
+            return
+        state = self._values.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+        for i, bound in enumerate(self.buckets):
+            state[0][i] += value['buckets'][bound]
+        state[1] += value['count']
+        state[2] += value['sum']
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the number of seconds taken by the with block."""
+        t1 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - t1, **labels)
+
+    def _render_value(self, key, value):
+        counts, count, total = value
+        lines = []
+        for bound, n in zip(self.buckets, counts):
+            labels = self._format_labels(key, [('le', _number(bound))])
+            lines.append('{}_bucket{} {}\n'.format(self.name, labels, n))
+        labels = self._format_labels(key, [('le', '+Inf')])
+        lines.append('{}_bucket{} {}\n'.format(self.name, labels, count))
+        labels = self._format_labels(key)
+        lines.append('{}_sum{} {}\n'.format(self.name, labels, _number(total)))
+        lines.append('{}_count{} {}\n'.format(self.name, labels, count))
+        return lines
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+def _pairs(labels):
+    return tuple(sorted(labels.items()))
+
+def _parse_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+class Scheduler:
+    """Run jobs on independent, wall-clock-aligned intervals.
+
+    Each job runs at multiples of its interval since the epoch (e.g., a job
+    with an interval of 60 runs at the top of every minute), so its schedule
+    does not drift no matter how long the job takes. Jobs run concurrently in
+    a thread pool. If a job is still running when it is next due, or if a
+    slot is missed, that run is skipped rather than queued.
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def every(self, interval, func, name=None, immediate=False):
+        """Schedule func to run every interval seconds.
+
+        Keyword arguments:
+        interval -- number of seconds between runs
+        func -- callable taking no arguments
+        name -- name used in log messages (default: func.__name__)
+        immediate -- run once as soon as the scheduler starts, rather than
+                     waiting for the first aligned slot (default: False)
+        """
+        self.jobs.append(_Job(interval, func, name or func.__name__, immediate))
+
+    def run(self, stop):
+        """Run jobs until the threading.Event stop is set."""
+        with ThreadPoolExecutor(max_workers=max(len(self.jobs), 1)) as executor:
+            now = time.time()
+            for job in self.jobs:
+                job.due = now if job.immediate else job.next_slot(now)
+            while not stop.is_set():
+                now = time.time()
+                for job in self.jobs:
+                    if job.due > now:
+                        continue
+                    if job.future is not None and not job.future.done():
+                        logger.warning('Job %s still running: skipping run', job.name)
+                    else:
+                        job.future = executor.submit(job.run)
+                    job.due = job.next_slot(now)
+                delay = min(job.due for job in self.jobs) - time.time()
+                stop.wait(max(delay, 0))
+
+
+class _Job:
+    def __init__(self, interval, func, name, immediate):
+        self.interval = interval
+        self.func = func
+        self.name = name
+        self.immediate = immediate
+        self.due = None
+        self.future = None
+
+    def next_slot(self, now):
+        return (math.floor(now / self.interval) + 1) * self.interval
+
+    def run(self):
+        try:
+            self.func()
+        except Exception:
+            logger.exception('Job %s failed', self.name)
@@ -1,57 +1,146 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
 import logging
+import statistics
+import struct
 import time
-import Adafruit_DHT as DHT
 
-def read(pin, threshold=32, cache='/dev/shm/dht22', tolerance=5):
+from .. import hardware
+from .. import metrics
+from ..deadline import Deadline
+
+# Adafruit_DHT.read holds the GIL while it bit-bangs the sensor, so the client
+# never reads the DHT22 alongside timing-sensitive sensors (see
+# utils.read_sensor()).
+EXCLUSIVE = True
+
+# Each history record is a timestamp, temperature and humidity.
+RECORD = struct.Struct('<dff')
+
+# Recent readings for each pin and cache file. The cache file is only read the
+# first time the sensor is read in a process, so a long-running process keeps
+# its history in memory.
+_histories = {}
+
+ATTEMPTS = metrics.histogram(
+    'therminator_dht22_read_attempts',
+    'Attempts needed per DHT22 reading',
+    buckets=metrics.COUNT_BUCKETS,
+)
+
+def read(pin, threshold=32, cache='/dev/shm/dht22-{pin}', tolerance=5,
+         timeout=60, retries=15, delay=2, history=10, max_age=3600):
     """Return the external temperature and humidity.
     
     Keyword arguments:
     pin -- the GPIO pin connected to the DHT22's data pin
+    cache -- file in which to keep recent readings, or None; {pin} is
+             replaced by the pin, so that sensors on different pins keep
+             separate histories (default: /dev/shm/dht22-{pin})
+    tolerance -- minimum deviation (in °C) from recent readings that is
+                 treated as a bad reading and retried (default: 5)
+    timeout -- number of seconds after which to give up (default: 60)
+    retries -- number of attempts per reading (default: 15)
+    delay -- number of seconds between attempts (default: 2)
+    history -- number of recent readings to keep (default: 10)
+    max_age -- ignore recent readings older than this many seconds
+               (default: 3600)
+
+    A reading is only retried if it is an outlier compared to the median of
+    the recent readings (a Hampel filter), so a single earlier bad reading
+    does not trigger a retry.
     """
     logger = logging.getLogger(__name__)
+    deadline = Deadline(timeout, 'Timed out waiting for data from DHT22 sensor')
 
-    ref = read_reference(cache, logger)
+    if cache is not None:
+        cache = cache.format(pin=pin)
+    samples = load_history(cache, history, logger, pin)
     logger.debug('Started reading sensor')
     t1 = time.time()
-    humidity, temp = DHT.read_retry(DHT.DHT22, pin)
-    write_reference(cache, temp, logger)
-    if ref is not None and abs(temp - ref) > tolerance:
-        logger.warning('reading offset exceeds {:.0f}C: retrying'.format(tolerance))
-        logger.debug('last reading was {:.1f}C, new reading is {:.1f}C'.format(ref, temp))
-        humidity, temp = DHT.read_retry(DHT.DHT22, pin)
-        write_reference(cache, temp, logger)
+    humidity, temp = read_retry(pin, retries, delay, deadline)
+    if temp is None or humidity is None:
+        raise RuntimeError('DHT22 sensor returned incomplete data')
+    recent = [t for ts, t, _ in samples if t1 - ts <= max_age]
+    if is_outlier(temp, recent, tolerance):
+        ref = statistics.median(recent)
+        logger.warning('reading offset exceeds %.1fC: retrying', tolerance)
+        logger.debug('median reading was %.1fC, new reading is %.1fC', ref, temp)
+        first = temp
+        humidity, temp = read_retry(pin, retries, delay, deadline)
+        if temp is not None and abs(temp - first) <= tolerance:
+            # Two readings in a row agree, so the temperature really changed.
+            logger.debug('Retry confirmed reading: discarding history')
+            samples.clear()
     t2 = time.time()
     if temp is None or humidity is None:
         raise RuntimeError('DHT22 sensor returned incomplete data')
+    samples.append((t2, temp, humidity))
+    save_history(cache, samples, logger)
     if temp > threshold:
-        logger.warning(
-            'temp {:.1f}C exceeds threshold {:.1f}C' \
-            .format(temp, threshold)
-        )
-    logger.info('temp={:.1f}C humidity={:.1f}%'.format(temp, humidity))
-    logger.debug('Finished reading sensor ({:.1f}s)'.format(t2-t1))
+        logger.warning('temp %.1fC exceeds threshold %.1fC', temp, threshold)
+    logger.info('temp=%.1fC humidity=%.1f%%', temp, humidity)
+    logger.debug('Finished reading sensor (%.1fs)', t2-t1)
     return temp, humidity
 
-def read_reference(cache, logger):
+def read_retry(pin, retries, delay, deadline):
+    """Return humidity and temperature, retrying until the sensor responds.
+
+    This is equivalent to Adafruit_DHT.read_retry, except that it gives up
+    once deadline has passed.
+    """
+    DHT = hardware.dht()
+    attempts = 0
+    try:
+        for _ in range(retries):
+            attempts += 1
+            humidity, temp = DHT.read(DHT.DHT22, pin)
+            if humidity is not None and temp is not None:
+                return humidity, temp
+            deadline.sleep(delay)
+        return None, None
+    finally:
+        ATTEMPTS.observe(attempts)
+
+def is_outlier(temp, recent, tolerance, k=3):
+    """Return True if temp is an outlier compared to recent temperatures.
+
+    A reading is an outlier if it differs from the median of the recent
+    readings by more than tolerance and by more than k scaled median
+    absolute deviations.
+    """
+    if not recent:
+        return False
+    median = statistics.median(recent)
+    mad = statistics.median([abs(t - median) for t in recent])
+    return abs(temp - median) > max(tolerance, k * 1.4826 * mad)
+
+def load_history(cache, size, logger, pin=None):
+    """Return the deque of recent readings for the pin and cache file."""
+    key = (pin, cache)
+    if key in _histories and _histories[key].maxlen == size:
+        return _histories[key]
+    samples = collections.deque(maxlen=size)
     if cache is not None:
-        logger.debug('Read reference temperature from cache')
+        logger.debug('Read recent readings from cache')
         try:
-            with open(cache, 'r') as f:
-                data = f.readline()
-                return float(data)
+            with open(cache, 'rb') as f:
+                data = f.read()
+            samples.extend(RECORD.iter_unpack(data))
         except FileNotFoundError:
             logger.warning('Reference cache file does not exist')
-        except ValueError:
-            logger.warning('Could not parse reference temeprature: {!r}'.format(data))
+        except struct.error:
+            logger.warning('Could not parse reference cache file %s', cache)
+    _histories[key] = samples
+    return samples
 
-def write_reference(cache, ref, logger):
+def save_history(cache, samples, logger):
     if cache is not None:
-        logger.debug('Write new reference temperature to cache')
-        with open(cache, 'w+') as f:
-            f.write('{:f}\n'.format(ref))
+        logger.debug('Write recent readings to cache')
+        with open(cache, 'wb') as f:
+            f.write(b''.join(RECORD.pack(*sample) for sample in samples))
 
 
 if __name__ == '__main__':
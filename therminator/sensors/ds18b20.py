@@ -1,70 +1,248 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
 import glob
 import logging
+import os
 import time
 
+from .. import hardware
+from .. import metrics
+from .. import sysfs
+from ..deadline import Deadline
+
 logger = logging.getLogger(__name__)
 
-def read(file=None, timeout=10, wait=0.2, threshold=32):
+BUS = '/sys/devices/w1_bus_master1'
+
+# Seconds per temperature conversion at each resolution (in bits).
+CONVERSION_TIMES = {9: 0.09375, 10: 0.1875, 11: 0.375, 12: 0.75}
+
+# Discovered devices for each bus, keyed on the bus's slave listing so the
+# index is only rebuilt when probes are added or removed.
+_devices = {}
+
+# Resolution last set on each 1-wire interface file.
+_resolutions = {}
+
+CRC_FAILURES = metrics.counter(
+    'therminator_ds18b20_crc_failures_total',
+    'DS18B20 reads that failed the CRC check',
+    labels=('device',),
+)
+
+def read(file=None, timeout=10, wait=None, threshold=32, device=None,
+         resolution=None):
     """Return the external temperature.
 
     Keyword arguments:
     file -- the path to the 1-wire serial interface file
     timeout -- number of seconds without a reading after which to give up
     wait -- number of seconds to wait after a failed read before retying
+            (default: a quarter of the conversion time)
     threshold -- log a warning if temperature exceed threshold
+    device -- the ID of the probe to read (e.g., 28-000008763d4a) if file is
+              not given and more than one probe is attached
+    resolution -- the resolution in bits (9-12) to set on the probe; lower
+                  resolutions convert faster (default: leave unchanged)
 
     Although the DS18B20 only measures the temperature, this method returns a
     two-element tuple to allow easier interchangibility with the DHT22 which
     returns temperature and humidity.
     """
     if file is None:
-        file = _discover()
+        file = _discover(device)
+    else:
+        file = hardware.path(file)
 
-    logger.debug('Started reading sensor at {}'.format(file))
+    _set_resolution(file, resolution)
+    wait = _poll_interval(resolution, wait)
+    logger.debug('Started reading sensor at %s', file)
     t1 = time.time()
     try:
         temp = _read(file, timeout, wait)
-    except (RuntimeError, FileNotFoundError) as e:
+    except (RuntimeError, TimeoutError, FileNotFoundError) as e:
         logger.warn(e.args)
         raise
     t2 = time.time()
-    if temp > threshold:
-        logger.warning(
-            'temp {:.1f}C exceeds threshold {:.1f}C' \
-            .format(temp, threshold)
-        )
-    logger.info('temp={:.1f}C'.format(temp))
-    logger.debug('Finished reading sensor ({:.1f}s)'.format(t2-t1))
+    _check_threshold(temp, threshold)
+    logger.info('temp=%.1fC', temp)
+    logger.debug('Finished reading sensor (%.1fs)', t2-t1)
     return temp, None
 
+def read_all(bus=BUS, timeout=10, wait=None, threshold=32, resolution=None):
+    """Return the temperatures of all probes on the bus.
+
+    Keyword arguments:
+    bus -- the path to the 1-wire bus master
+    timeout -- number of seconds without a reading after which to give up
+    wait -- number of seconds to wait after a failed read before retying
+            (default: a quarter of the conversion time)
+    threshold -- log a warning if temperature exceed threshold
+    resolution -- the resolution in bits (9-12) to set on every probe
+                  (default: leave unchanged)
+
+    Returns a dictionary mapping device ID to temperature. A probe that
+    cannot be read maps to None. If the kernel supports it, all probes are
+    told to convert at once through the bus's therm_bulk_read file, so
+    reading N probes takes about as long as reading one.
+    """
+    bus = hardware.path(bus)
+    devices = discover(bus)
+    for file in devices.values():
+        _set_resolution(file, resolution)
+    wait = _poll_interval(resolution, wait)
+    logger.debug('Started reading %s sensor(s) on %s', len(devices), bus)
+    t1 = time.time()
+    _bulk_convert(bus, timeout, wait)
+    temps = {}
+    for device, file in devices.items():
+        try:
+            temps[device] = _read(file, timeout, wait)
+        except (RuntimeError, TimeoutError, FileNotFoundError) as e:
+            logger.warning('Failed to read %s: %s', device, e)
+            temps[device] = None
+            continue
+        _check_threshold(temps[device], threshold)
+        logger.info('device=%s temp=%.1fC', device, temps[device])
+    t2 = time.time()
+    logger.debug('Finished reading sensors (%.1fs)', t2-t1)
+    return temps
+
+def prepare(options):
+    """Start a conversion on the bus of each probe that is about to be read.
+
+    Keyword arguments:
+    options -- list of the keyword arguments of each read() to come
+
+    The client calls this once per cycle before reading its DS18B20 channels
+    (see utils.read_sensors()), so the probes then return their readings
+    without converting one after another. Does nothing on kernels that lack
+    therm_bulk_read.
+    """
+    buses = collections.OrderedDict()
+    for kwargs in options:
+        if kwargs.get('file') is None:
+            bus = hardware.path(BUS)
+        else:
+            device = os.path.realpath(os.path.dirname(hardware.path(kwargs['file'])))
+            bus = os.path.dirname(device)
+        buses.setdefault(bus, kwargs)
+    for bus, kwargs in buses.items():
+        wait = _poll_interval(kwargs.get('resolution'), kwargs.get('wait'))
+        logger.debug('Starting conversion on %s', bus)
+        _bulk_convert(bus, kwargs.get('timeout', 10), wait)
+
+def discover(bus=BUS):
+    """Return a dictionary mapping device ID to 1-wire interface file.
+
+    The result is cached and only refreshed when the bus's list of slaves
+    changes.
+    """
+    bus = hardware.path(bus)
+    try:
+        with open('{}/w1_master_slaves'.format(bus)) as f:
+            key = f.read()
+    except FileNotFoundError:
+        key = None
+    if key is not None and bus in _devices and _devices[bus][0] == key:
+        return _devices[bus][1]
+
+    logger.debug('Discovering sensors on %s', bus)
+    devices = {}
+    for path in sorted(glob.glob('{}/28-*'.format(bus))):
+        devices[os.path.basename(path)] = '{}/w1_slave'.format(path)
+    logger.info('Discovered %s 1-wire interface(s): %s', len(devices), ', '.join(devices))
+    if key is not None:
+        _devices[bus] = (key, devices)
+    return devices
+
+def _poll_interval(resolution, wait):
+    if wait is not None:
+        return wait
+    return CONVERSION_TIMES[resolution or 12] / 4
+
+def _set_resolution(file, resolution):
+    """Set the probe's resolution through sysfs if it is not already set."""
+    if resolution is None or _resolutions.get(file) == resolution:
+        return
+    if resolution not in CONVERSION_TIMES:
+        raise ValueError('DS18B20 resolution must be 9, 10, 11 or 12 bits')
+    path = os.path.join(os.path.dirname(file), 'resolution')
+    try:
+        with open(path) as f:
+            current = int(f.read())
+        if current != resolution:
+            logger.info('Setting resolution of %s to %s bits', file, resolution)
+            with open(path, 'w') as f:
+                f.write('{}\n'.format(resolution))
+    except (OSError, ValueError) as e:
+        logger.warning('Could not set resolution of %s: %s', file, e)
+    _resolutions[file] = resolution
+
+def _check_threshold(temp, threshold):
+    if temp > threshold:
+        logger.warning('temp %.1fC exceeds threshold %.1fC', temp, threshold)
+
 def _read(file, timeout, wait):
-    for _ in range(int(timeout/wait)):
-        data = _raw_read(file)
-        if data[0].endswith('YES'):
-            i = data[1].find('t=')
-            return float(data[1][i+2:]) / 1000
-        time.sleep(wait)
-    raise RuntimeError('Timed out waiting for data from DS18B20 sensor')
-
-def _raw_read(file):
-    with open(file) as f:
-        return f.read().splitlines()
-
-def _discover():
-    logger.debug('Discovering sensor')
-    sensors = glob.glob('/sys/devices/w1_bus_master1/28-*')
-    if len(sensors) == 0:
-        raise RuntimeError('Sensor discovery failed: no 1-wire interfaces exist')
-    elif len(sensors) > 1:
-        raise RuntimeError('Sensor discovery failed: more than one 1-wire interface exists')
+    deadline = Deadline(timeout, 'Timed out waiting for data from DS18B20 sensor')
+    while True:
+        # file may come from discover()'s cache, so look it up on every read
+        # (which lets a simulated probe return a fresh value).
+        millidegrees = sysfs.parse(hardware.path(file), _parse_w1_slave)
+        if millidegrees is not None:
+            return millidegrees / 1000
+        CRC_FAILURES.inc(device=os.path.basename(os.path.dirname(file)))
+        deadline.sleep(wait)
 
-    file = '{}/w1_slave'.format(sensors[0])
-    logger.info('Discovered 1-wire interface file at {}'.format(file))
+def _parse_w1_slave(buffer, n):
+    """Return the temperature (in m°C) in a w1_slave file, or None.
 
-    return file
+    The file holds two lines, e.g.:
+
+        50 01 4b 46 7f ff 0c 10 1c : crc=1c YES
+        50 01 4b 46 7f ff 0c 10 1c t=21000
+
+    If the first line does not end in YES, the CRC check failed and None is
+    returned.
+    """
+    eol = buffer.find(b'\n', 0, n)
+    if eol < 0 or not buffer.endswith(b'YES', 0, eol):
+        return None
+    i = buffer.find(b't=', eol, n)
+    if i < 0:
+        return None
+    return int(buffer[i+2:n])
+
+def _bulk_convert(bus, timeout, wait):
+    """Start a conversion on every probe at once and wait for it to finish.
+
+    Does nothing if the kernel's w1_therm driver lacks therm_bulk_read.
+    """
+    file = '{}/therm_bulk_read'.format(bus)
+    if not os.path.exists(file):
+        return
+    deadline = Deadline(timeout, 'Timed out waiting for DS18B20 bulk conversion')
+    with open(file, 'w') as f:
+        f.write('trigger\n')
+    while True:
+        # -1 means at least one probe is still converting.
+        if sysfs.read_int(file) != -1:
+            return
+        deadline.sleep(wait)
+
+def _discover(device=None):
+    devices = discover()
+    if device is not None:
+        if device not in devices:
+            raise RuntimeError('Sensor discovery failed: no 1-wire interface for {}'.format(device))
+        return devices[device]
+    if len(devices) == 0:
+        raise RuntimeError('Sensor discovery failed: no 1-wire interfaces exist')
+    elif len(devices) > 1:
+        raise RuntimeError('Sensor discovery failed: more than one 1-wire interface exists')
+    return next(iter(devices.values()))
 
 
 if __name__ == '__main__':
@@ -87,8 +265,14 @@ if __name__ == '__main__':
     parser.add_argument('-w', '--wait',
                         type=float,
                         metavar='N',
-                        default=0.2,
                         help='Wait N seconds after failure before retrying')
+    parser.add_argument('-r', '--resolution',
+                        type=int,
+                        choices=sorted(CONVERSION_TIMES),
+                        help='Set probe resolution in bits')
+    parser.add_argument('-a', '--all',
+                        action='store_true',
+                        help='Read every probe on the 1-wire bus')
     parser.add_argument('-d', '--debug',
                         action='store_true',
                         help='Enable debugging output')
@@ -97,5 +281,13 @@ if __name__ == '__main__':
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    temp, _ = read(args.file)
-    print('temp={}'.format(args.convert(temp)))
+    if args.all:
+        temps = read_all(timeout=args.timeout, wait=args.wait,
+                         resolution=args.resolution)
+        for device, temp in sorted(temps.items()):
+            if temp is not None:
+                print('device={} temp={}'.format(device, args.convert(temp)))
+    else:
+        temp, _ = read(args.file, timeout=args.timeout, wait=args.wait,
+                       resolution=args.resolution)
+        print('temp={}'.format(args.convert(temp)))
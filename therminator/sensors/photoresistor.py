@@ -3,13 +3,39 @@
 
 import logging
 import math
-import signal
+import threading
 import time
-from RPi import GPIO
+
+from .. import hardware
+from .. import metrics
+from ..deadline import Deadline
 
 logger = logging.getLogger(__name__)
 
-def read(pins, capacitance, resistance, voltage=3.3, n=20, timeout=300):
+TIMEOUT_MESSAGE = (
+    'Timed out while taking readings from photoresistor. '
+    'Try using a smaller capacitor or taking fewer readings.'
+)
+
+# Charge times are measured in microseconds, so the client never reads the
+# photoresistor while a sensor that holds the GIL (the DHT22) is being read
+# (see utils.read_sensor()).
+EXCLUSIVE = True
+
+# Set if edge detection turns out to be unavailable, so we stop trying it.
+_edge_unavailable = False
+
+# Fewest samples an adaptive read takes before checking for convergence.
+MIN_SAMPLES = 5
+
+SAMPLES = metrics.histogram(
+    'therminator_photoresistor_samples',
+    'Charge cycles taken per photoresistor reading',
+    buckets=metrics.COUNT_BUCKETS,
+)
+
+def read(pins, capacitance, resistance, voltage=3.3, n=20, timeout=300,
+         mode='poll', adaptive=False, precision=0.02, budget=None):
     """Return the average resistance of the photoresistor.
 
     Keyword arguments:
@@ -19,6 +45,24 @@ def read(pins, capacitance, resistance, voltage=3.3, n=20, timeout=300):
     voltage -- the input voltage (in V) (default: 3.3)
     n -- the number of readings over which to average (default: 20)
     timeout -- the number of seconds after which to give up (default: 300)
+    mode -- how to detect the capacitor charging, 'poll' or 'edge'
+            (default: 'poll')
+
+    In 'poll' mode the charge pin is read in a busy loop, which keeps a CPU
+    core fully occupied for the duration of the measurement. In 'edge' mode
+    the thread sleeps until GPIO edge detection reports the rising edge. If
+    edge detection is unavailable, 'edge' mode falls back to polling.
+
+    Adaptive keyword arguments:
+    adaptive -- stop sampling once the estimate is precise enough, taking at
+                most n readings (default: False)
+    precision -- stop once the 95% confidence interval of the mean is
+                 within this fraction of the mean (default: 0.02)
+    budget -- stop after this many seconds, if at least MIN_SAMPLES
+              readings have been taken (default: None)
+
+    In adaptive mode, the capacitor is also discharged for a time derived
+    from its RC time constant rather than a fixed 10ms.
     """
     logger.debug('Started reading sensor')
     try:
@@ -29,64 +73,152 @@ def read(pins, capacitance, resistance, voltage=3.3, n=20, timeout=300):
             R=resistance,
             V=voltage,
             n=n,
-            timeout=timeout
+            timeout=timeout,
+            edge=(mode == 'edge'),
+            adaptive=adaptive,
+            precision=precision,
+            budget=budget,
         )
         t2 = time.time()
-        logger.info('resistance={:.1f}ohms'.format(reading))
+        logger.info('resistance=%.1fohms', reading)
         if reading < 0:
             logger.warning('negative resistance will be normalized to 0.0')
             reading = 0
-        logger.debug('Finished reading sensor ({:.1f}s)'.format(t2-t1))
+        logger.debug('Finished reading sensor (%.1fs)', t2-t1)
         return reading
     except TimeoutError as e:
         logger.warn(e.args)
         raise
 
-def _multiread(pins, C, R, V, n, timeout):
-    try:
-        signal.signal(signal.SIGALRM, _timeout)
-        signal.alarm(timeout)
-        data = [_read(pins, C, R, V) for _ in range(n+2)]
-        data.sort()
-        logger.debug('Discard min and max values: min={:f}us, max={:f}us'.format(data[0], data[-1]))
-        mean = sum(data[1:-1]) / n
-    finally:
-        signal.alarm(0)
+def _multiread(pins, C, R, V, n, timeout, edge=False, adaptive=False,
+               precision=0.02, budget=None):
+    estimate = _TrimmedMean()
+    wait = _discharge_time(R, C) if adaptive else 0.01
+    deadline = Deadline(timeout, TIMEOUT_MESSAGE)
+    t1 = time.monotonic()
+    while estimate.count < n+2:
+        estimate.add(_read(pins, C, R, V, edge, wait, deadline))
+        if not adaptive or estimate.count < MIN_SAMPLES:
+            continue
+        if estimate.halfwidth() <= precision * estimate.mean():
+            logger.debug('Estimate converged after %s readings', estimate.count)
+            break
+        if budget is not None and time.monotonic() - t1 >= budget:
+            logger.debug('Budget exhausted after %s readings', estimate.count)
+            break
+    logger.debug(
+        'Discard min and max values: min=%fus, max=%fus',
+        estimate.min,
+        estimate.max,
+    )
+    SAMPLES.observe(estimate.count)
+    mean = estimate.mean()
     T = mean * (math.e-1)/math.e * V
     return T/C - R
 
-def _timeout(signum, frame):
-    raise TimeoutError(
-        'Timed out while taking readings from photoresistor. '
-        'Try using a smaller capacitor or taking fewer readings.'
-    )
+def _discharge_time(R, C):
+    """Return seconds needed to discharge the capacitor to within 0.1%."""
+    return max(7 * R * C / 10**6, 0.0001)
+
 
-def _read(pins, C, R, V):
+class _TrimmedMean:
+    """Running mean of samples, excluding the minimum and maximum."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.count += 1
+        self.total += x
+        self.squares += x*x
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def mean(self):
+        return (self.total - self.min - self.max) / (self.count - 2)
+
+    def halfwidth(self, z=1.96):
+        """Return the half-width of the confidence interval of the mean."""
+        k = self.count - 2
+        if k < 2:
+            return float('inf')
+        mean = self.mean()
+        squares = self.squares - self.min**2 - self.max**2
+        variance = max(squares - k*mean*mean, 0) / (k-1)
+        return z * math.sqrt(variance / k)
+
+
+def _read(pins, C, R, V, edge=False, wait=0.01, deadline=None):
     a, b = pins
+    if deadline is None:
+        deadline = Deadline(None)
     try:
-        _discharge(a, b)
-        elapsed_time = _charge(a, b)
-        logger.debug('elapsed-time={:f}us'.format(elapsed_time))
+        _discharge(a, b, wait)
+        elapsed_time = _charge(a, b, edge, deadline)
+        logger.debug('elapsed-time=%fus', elapsed_time)
         return elapsed_time
     finally:
-        _discharge(a, b)
+        _discharge(a, b, wait)
 
-def _discharge(a, b):
+def _discharge(a, b, wait=0.01):
+    GPIO = hardware.gpio()
     GPIO.setup(a, GPIO.IN)
     GPIO.setup(b, GPIO.OUT)
     GPIO.output(b, GPIO.LOW)
-    time.sleep(0.01)
+    time.sleep(wait)
 
-def _charge(a, b):
+def _charge(a, b, edge, deadline):
+    GPIO = hardware.gpio()
     GPIO.setup(a, GPIO.OUT)
     GPIO.setup(b, GPIO.IN)
+    if edge and not _edge_unavailable:
+        try:
+            return _charge_edge(a, b, deadline)
+        except RuntimeError as e:
+            _disable_edge(e)
     GPIO.output(a, GPIO.HIGH)
-    t1 = time.time()
+    t1 = time.perf_counter()
+    i = 0
     while not GPIO.input(b):
-        pass
-    t2 = time.time()
+        # Checking the deadline on every pass would coarsen the timing.
+        i += 1
+        if i % 1000 == 0:
+            deadline.check()
+    t2 = time.perf_counter()
     return (t2-t1) * 10**6
 
+def _charge_edge(a, b, deadline):
+    # Edge detection is armed before charging starts so a fast rising edge
+    # cannot be missed. The callback runs on RPi.GPIO's event thread.
+    GPIO = hardware.gpio()
+    charged = threading.Event()
+    times = []
+
+    def _rising(channel):
+        times.append(time.perf_counter())
+        charged.set()
+
+    GPIO.add_event_detect(b, GPIO.RISING, callback=_rising)
+    try:
+        GPIO.output(a, GPIO.HIGH)
+        t1 = time.perf_counter()
+        if not charged.wait(deadline.remaining()):
+            raise TimeoutError(deadline.message)
+    finally:
+        GPIO.remove_event_detect(b)
+    return (times[0]-t1) * 10**6
+
+def _disable_edge(e):
+    global _edge_unavailable
+    _edge_unavailable = True
+    logger.warning('Edge detection unavailable, falling back to polling: %s', e)
+
 if __name__ == '__main__':
     import argparse
 
@@ -121,11 +253,19 @@ if __name__ == '__main__':
                         type=int,
                         default=20,
                         help='Number of readings over which to average')
+    parser.add_argument('-a', '--adaptive',
+                        action='store_true',
+                        help='Stop sampling once the estimate is precise enough')
+    parser.add_argument('-m', '--mode',
+                        choices=['poll', 'edge'],
+                        default='poll',
+                        help='Detect charging by polling or edge detection')
     parser.add_argument('-d', '--debug',
                         action='store_true',
                         help='Enable deubgging output')
     args = parser.parse_args()
 
+    GPIO = hardware.gpio()
     try:
         if args.debug:
             logging.basicConfig(level=logging.DEBUG)
@@ -137,7 +277,9 @@ if __name__ == '__main__':
             resistance=args.resistance,
             voltage=args.voltage,
             timeout=args.timeout,
-            n=args.n
+            n=args.n,
+            mode=args.mode,
+            adaptive=args.adaptive,
         )
         print(
             'resistance={:.1f}Ω luminosity={:.1f}' \
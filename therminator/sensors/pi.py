@@ -1,31 +1,75 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
+import glob
 import logging
+import os
 import re
 import time
 
-def read(file='/sys/class/thermal/thermal_zone0/temp'):
+from .. import hardware
+from .. import sysfs
+
+THERMAL = '/sys/class/thermal'
+
+# Thermal zones found by read_all(), for each pattern.
+_zones = {}
+
+def read(file='/sys/class/thermal/thermal_zone0/temp', zones=None):
     """Return the internal temperature.
 
     Keyword arguments:
     file -- path to kernal interface file for internal temperature
+    zones -- glob matching the names of thermal zones to read instead of
+             file (e.g., thermal_zone*) (default: None)
 
     The default value for file, /sys/class/thermal/thermal_zone0/temp, is a
     safe bet for a device as simple as a Raspberry Pi. On a device with
     multiple internal temperature zones, you can consult the type file in the
     same directory to identify the correct zone.
+
+    If zones is given, every matching zone is read in one pass and their
+    temperatures are returned as a tuple in zone order, so that a channel can
+    post them as its fields.
     """
+    if zones is not None:
+        return tuple(read_all(zones).values())
     logger = logging.getLogger(__name__)
     logger.debug('Started reading sensor')
     t1 = time.time()
-    with open(file) as f:
-        temp = float(f.read()) / 1000
+    temp = sysfs.read_int(hardware.path(file)) / 1000
     t2 = time.time()
-    logger.info('int_temp={:.1f}C'.format(temp))
-    logger.debug('Finished reading sensor ({:.1f}s)'.format(t2-t1))
+    logger.info('int_temp=%.1fC', temp)
+    logger.debug('Finished reading sensor (%.1fs)', t2-t1)
     return temp
 
+def read_all(pattern='thermal_zone*'):
+    """Return the temperature of every thermal zone.
+
+    Keyword arguments:
+    pattern -- glob matching the names of the zones to read (default:
+               thermal_zone*)
+
+    Returns an ordered dictionary mapping each zone's name (e.g.,
+    thermal_zone0) to its temperature, in order of zone number.
+    """
+    logger = logging.getLogger(__name__)
+    if pattern not in _zones:
+        paths = glob.glob(hardware.path('{}/{}/temp'.format(THERMAL, pattern)))
+        zones = [os.path.basename(os.path.dirname(p)) for p in paths]
+        _zones[pattern] = sorted(zones, key=_zone_number)
+    temps = collections.OrderedDict()
+    for zone in _zones[pattern]:
+        file = hardware.path('{}/{}/temp'.format(THERMAL, zone))
+        temps[zone] = sysfs.read_int(file) / 1000
+        logger.info('zone=%s temp=%.1fC', zone, temps[zone])
+    return temps
+
+def _zone_number(zone):
+    """Return a sort key that puts thermal_zone2 before thermal_zone10."""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', zone)]
+
 
 if __name__ == '__main__':
     import argparse
@@ -41,7 +85,14 @@ if __name__ == '__main__':
                         default='/sys/class/thermal/thermal_zone0/temp',
                         help='Path to kernel interface to CPU temperature' \
                              ' (default: /sys/class/thermal/thermal_zone0/temp)')
+    parser.add_argument('-a', '--all',
+                        action='store_true',
+                        help='Read every thermal zone')
     args = parser.parse_args()
 
-    temp = read(args.file)
-    print('temp={}'.format(args.convert(temp)))
+    if args.all:
+        for zone, temp in read_all().items():
+            print('zone={} temp={}'.format(zone, args.convert(temp)))
+    else:
+        temp = read(args.file)
+        print('temp={}'.format(args.convert(temp)))
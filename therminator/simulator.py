@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Simulated hardware for running the client without a Raspberry Pi.
+
+Select it with hardware.use('simulated') or `python3 -m therminator
+--simulate`. Options for SimulatedBackend may be given in the simulate
+section of the config file.
+"""
+
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class SimulatedBackend:
+    """Simulated GPIO, DHT22 and sysfs tree.
+
+    The sysfs tree is created in a temporary directory, and paths under /sys
+    are mapped into it. Each simulated file is rewritten with a fresh value
+    whenever a sensor looks up its path, whether by its path under /sys or
+    by the mapped path (e.g., one that a sensor has cached).
+    """
+
+    def __init__(self, root=None, cpu_temp=45.0, temp=21.0, humidity=45.0,
+                 probes=1, pins=(22, 17), light=10000, resistance=1000,
+                 capacitance=0.1, voltage=3.3, noise=0.02, dht_latency=0.25,
+                 dht_failure_rate=0.2):
+        """
+        Keyword arguments:
+        root -- directory in which to create the sysfs tree (default: a new
+                temporary directory)
+        cpu_temp -- internal temperature (in °C) (default: 45.0)
+        temp -- external temperature (in °C) (default: 21.0)
+        humidity -- relative humidity (in %) (default: 45.0)
+        probes -- number of DS18B20 probes on the 1-wire bus (default: 1)
+        pins -- the GPIO pins of the photoresistor circuit (charging,
+                discharging) (default: (22, 17))
+        light -- resistance (in Ω) of the photoresistor (default: 10000)
+        resistance -- resistance (in Ω) of the photoresistor circuit's
+                      fixed resistor (default: 1000)
+        capacitance -- capacitance (in μF) of the photoresistor circuit's
+                       capacitor (default: 0.1)
+        voltage -- input voltage (in V) (default: 3.3)
+        noise -- relative standard deviation of every value (default: 0.02)
+        dht_latency -- seconds taken by each DHT22 read (default: 0.25)
+        dht_failure_rate -- fraction of DHT22 reads that fail (default: 0.2)
+        """
+        self.root = root or tempfile.mkdtemp(prefix='therminator-')
+        self.cpu_temp = cpu_temp
+        self.temp = temp
+        self.humidity = humidity
+        self.noise = noise
+        self._gpio = FakeGPIO(
+            pins=pins,
+            light=light,
+            resistance=resistance,
+            capacitance=capacitance,
+            voltage=voltage,
+            noise=noise,
+        )
+        self._dht = FakeDHT(
+            temp=temp,
+            humidity=humidity,
+            latency=dht_latency,
+            failure_rate=dht_failure_rate,
+            noise=noise,
+        )
+        self._files = {}
+        self._build_sysfs(probes)
+        logger.info('Simulating hardware with sysfs tree at %s', self.root)
+
+    def gpio(self):
+        return self._gpio
+
+    def dht(self):
+        return self._dht
+
+    def path(self, file):
+        if file.startswith('/sys/'):
+            mapped = os.path.join(self.root, file.lstrip('/'))
+        else:
+            mapped = file
+        if mapped in self._files:
+            _write(mapped, self._files[mapped]())
+        return mapped
+
+    def _build_sysfs(self, probes):
+        self._add_file(
+            '/sys/class/thermal/thermal_zone0/temp',
+            lambda: '{:d}\n'.format(int(self._jitter(self.cpu_temp) * 1000)),
+        )
+        bus = '/sys/devices/w1_bus_master1'
+        devices = ['28-{:012x}'.format(i+1) for i in range(probes)]
+        self._add_file(bus + '/w1_master_slaves', lambda: ''.join(d + '\n' for d in devices))
+        for device in devices:
+            self._add_file('{}/{}/w1_slave'.format(bus, device), self._w1_slave)
+            self._add_file('{}/{}/resolution'.format(bus, device), lambda: '12\n')
+
+    def _add_file(self, file, generate):
+        mapped = os.path.join(self.root, file.lstrip('/'))
+        os.makedirs(os.path.dirname(mapped), exist_ok=True)
+        _write(mapped, generate())
+        self._files[mapped] = generate
+
+    def _w1_slave(self):
+        raw = '50 01 4b 46 7f ff 0c 10 1c'
+        millidegrees = int(self._jitter(self.temp) * 1000)
+        return '{} : crc=1c YES\n{} t={:d}\n'.format(raw, raw, millidegrees)
+
+    def _jitter(self, value):
+        return random.gauss(value, abs(value) * self.noise)
+
+
+class FakeGPIO:
+    """Simulation of the parts of RPi.GPIO used by the client.
+
+    The photoresistor circuit is attached to pins (charging, discharging).
+    Setting the charging pin HIGH starts charging the capacitor, and the
+    discharging pin reads HIGH once it has charged. Setting the discharging
+    pin LOW discharges it. The charge time follows the RC curve that the
+    photoresistor sensor assumes. Other pins (e.g., the LED) do nothing.
+    """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, pins, light, resistance, capacitance, voltage, noise):
+        self.pins = tuple(pins)
+        self.light = light
+        self.resistance = resistance
+        self.capacitance = capacitance
+        self.voltage = voltage
+        self.noise = noise
+        self.mode = None
+        self._charging_since = None
+        self._charge_time = None
+        self._callback = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, **kwargs):
+        pass
+
+    def output(self, channel, value):
+        a, b = self.pins
+        with self._lock:
+            if channel == b and value == self.LOW:
+                self._discharge()
+            elif channel == a and value == self.HIGH and self._charging_since is None:
+                self._charging_since = time.perf_counter()
+                self._charge_time = self._sample_charge_time()
+                if self._callback is not None:
+                    self._timer = threading.Timer(self._charge_time, self._callback, args=(b,))
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def input(self, channel):
+        with self._lock:
+            if channel != self.pins[1] or self._charging_since is None:
+                return self.LOW
+            elapsed = time.perf_counter() - self._charging_since
+            return self.HIGH if elapsed >= self._charge_time else self.LOW
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self._lock:
+            if self._callback is not None:
+                raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+            if channel == self.pins[1]:
+                self._callback = callback
+
+    def remove_event_detect(self, channel):
+        with self._lock:
+            self._callback = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def cleanup(self, channel=None):
+        with self._lock:
+            self._discharge()
+
+    def _discharge(self):
+        self._charging_since = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _sample_charge_time(self):
+        # Inverse of the photoresistor sensor's resistance calculation.
+        light = random.gauss(self.light, self.light * self.noise)
+        micros = (light + self.resistance) * self.capacitance \
+            * math.e / (math.e - 1) / self.voltage
+        return max(micros, 0) / 10**6
+
+
+class FakeDHT:
+    """Simulation of the parts of Adafruit_DHT used by the client."""
+
+    DHT22 = 22
+
+    def __init__(self, temp, humidity, latency, failure_rate, noise):
+        self.temp = temp
+        self.humidity = humidity
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.noise = noise
+
+    def read(self, sensor, pin):
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            return None, None
+        humidity = random.gauss(self.humidity, self.humidity * self.noise)
+        temp = random.gauss(self.temp, abs(self.temp) * self.noise)
+        return humidity, temp
+
+    def read_retry(self, sensor, pin, retries=15, delay_seconds=2):
+        for _ in range(retries):
+            humidity, temp = self.read(sensor, pin)
+            if humidity is not None and temp is not None:
+                return humidity, temp
+            time.sleep(delay_seconds)
+        return None, None
+
+
+def _write(file, data):
+    with open(file, 'w') as f:
+        f.write(data)
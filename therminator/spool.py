@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEPTH = metrics.gauge(
+    'therminator_spool_depth',
+    'Readings waiting in the spool to be posted',
+)
+
+class Spool:
+    """Durable on-disk queue of readings waiting to be posted.
+
+    Readings are stored in a SQLite database with synchronous writes, so a
+    reading that has been pushed survives a crash or power loss. The spool is
+    bounded: once it holds max_entries readings, the oldest are evicted to
+    make room for new ones.
+
+    Readings are drained in batches of up to batch_size. A partial batch is
+    held back until its oldest reading has waited batch_latency seconds.
+    """
+
+    def __init__(self, path, max_entries=50000, batch_size=1, batch_latency=0):
+        """
+        Keyword arguments:
+        path -- path to the SQLite database file
+        max_entries -- maximum number of readings to keep (default: 50000)
+        batch_size -- maximum number of readings posted at once (default: 1)
+        batch_latency -- seconds to hold back a partial batch (default: 0)
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        # The spool may be used from a different thread (e.g., the upload
+        # worker) than the one that opened it.
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS readings ('
+            '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  data TEXT NOT NULL,'
+            '  created REAL NOT NULL DEFAULT 0'
+            ')'
+        )
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(readings)')]
+        if 'created' not in columns:
+            self.conn.execute(
+                'ALTER TABLE readings ADD COLUMN created REAL NOT NULL DEFAULT 0')
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT count(*) FROM readings').fetchone()[0]
+
+    def push(self, data):
+        """Append a reading to the spool, evicting the oldest if it is full."""
+        with self._lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            cursor = self.conn.execute(
+                'INSERT INTO readings (data, created) VALUES (?, ?)',
+                (json.dumps(data), time.time()),
+            )
+            cursor = self.conn.execute(
+                'DELETE FROM readings WHERE id <= ?',
+                (cursor.lastrowid - self.max_entries,),
+            )
+        DEPTH.set(len(self))
+        if cursor.rowcount > 0:
+            logger.warning('Spool full: evicted %s oldest reading(s)', cursor.rowcount)
+
+    def peek(self, n=1):
+        """Return up to n of the oldest readings as (id, created, data)."""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT id, created, data FROM readings ORDER BY id LIMIT ?', (n,)).fetchall()
+        return [(id, created, json.loads(data)) for id, created, data in rows]
+
+    def remove(self, ids):
+        """Remove the readings with the given ids."""
+        with self._lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany(
+                'DELETE FROM readings WHERE id = ?', [(id,) for id in ids])
+
+    def drain(self, write):
+        """Post spooled readings in order until the spool is empty.
+
+        Keyword arguments:
+        write -- callable that posts a list of readings and returns True once
+                 the server has dealt with them, or False if they should be
+                 retried
+
+        Draining stops at the first batch that could not be posted, so
+        readings are always delivered in the order they were taken. Only one
+        process drains the spool at a time; if another process is already
+        draining, this returns immediately. Returns the number of readings
+        posted.
+        """
+        with open(self.path + '.lock', 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.debug('Spool is being drained by another process')
+                return 0
+
+            count = 0
+            while True:
+                entries = self.peek(self.batch_size)
+                if not entries:
+                    break
+                age = time.time() - entries[0][1]
+                if len(entries) < self.batch_size and age < self.batch_latency:
+                    logger.debug('Holding back partial batch of %s reading(s)', len(entries))
+                    break
+                if not write([data for _, _, data in entries]):
+                    logger.warning('Spool drain stopped: %s reading(s) pending', len(self))
+                    break
+                self.remove([id for id, _, _ in entries])
+                count += len(entries)
+            DEPTH.set(len(self))
+            if count > 0:
+                logger.debug('Drained %s reading(s) from spool', count)
+            return count
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Kept-open readers for kernel interface files.
+
+Reading a sysfs attribute from offset 0 makes the kernel generate it afresh,
+so a file descriptor can be opened once and re-read with pread rather than
+opening, reading and closing the file for every reading. Readers read into
+a buffer that is reused between reads, and the contents are parsed as bytes
+without decoding them to strings.
+"""
+
+import os
+import threading
+
+# os.preadv reads straight into the buffer, but is new in Python 3.7.
+_preadv = getattr(os, 'preadv', None)
+
+_readers = {}
+_lock = threading.Lock()
+
+def reader(file):
+    """Return the shared Reader for file, opening it if necessary."""
+    with _lock:
+        if file not in _readers:
+            _readers[file] = Reader(file)
+        return _readers[file]
+
+def read_int(file):
+    """Return the contents of file as an integer."""
+    return _call(file, Reader.read_int)
+
+def parse(file, func):
+    """Return func(buffer, n) for the n bytes of file read into buffer."""
+    return _call(file, Reader.parse, func)
+
+def close():
+    """Close all readers."""
+    with _lock:
+        for r in _readers.values():
+            r.close()
+        _readers.clear()
+
+def _call(file, method, *args):
+    r = reader(file)
+    try:
+        return method(r, *args)
+    except OSError:
+        # The file may have gone away (e.g., a probe was unplugged), so open
+        # it afresh next time.
+        with _lock:
+            if _readers.get(file) is r:
+                del _readers[file]
+        r.close()
+        raise
+
+
+class Reader:
+    """A kernel interface file kept open and re-read from offset 0."""
+
+    def __init__(self, file, size=4096):
+        """
+        Keyword arguments:
+        file -- path to the file
+        size -- size of the buffer, which bounds the bytes read (default:
+                4096, the most a sysfs attribute can hold)
+        """
+        self.file = file
+        self.fd = os.open(file, os.O_RDONLY)
+        self.buffer = bytearray(size)
+        self._lock = threading.Lock()
+
+    def read_int(self):
+        """Return the contents of the file as an integer."""
+        return self.parse(_parse_int)
+
+    def parse(self, func):
+        """Re-read the file and return func(buffer, n).
+
+        The buffer is only valid for the duration of the call, so func must
+        not keep a reference to it.
+        """
+        with self._lock:
+            return func(self.buffer, self._read())
+
+    def _read(self):
+        if _preadv is not None:
+            return _preadv(self.fd, [self.buffer], 0)
+        data = os.pread(self.fd, len(self.buffer), 0)
+        self.buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _parse_int(buffer, n):
+    return int(buffer[:n])
@@ -1,10 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from tkinter import Tk
-from . import app as _app
+from .app import main
 
-root = Tk()
-root.wm_title('Therminator')
-app = _app.App(root)
-root.mainloop()
+main()
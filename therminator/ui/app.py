@@ -2,17 +2,39 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+import queue
+import threading
 from tkinter import *
 from .. import utils
-from ..sensors import *
+from ..cache import Cache
+from ..health import Health
 
 
 class App:
+    """Window showing the latest readings.
+
+    Readings are taken on a background thread, so the window stays
+    responsive while the sensors are read, and the results are handed back
+    to the Tk main loop through a queue that it polls with after(). Only one
+    refresh runs at a time. If the config file has a ui section with an
+    interval, the readings are refreshed every interval seconds.
+    """
+
     FIELDS = ['Int Temp', 'Ext Temp', 'Humidity']
 
+    # Payload fields shown in the window.
+    SHOWN = {'int_temp', 'ext_temp', 'humidity'}
+
+    # Milliseconds between checks for the result of a refresh.
+    POLL_INTERVAL = 100
+
     def __init__(self, master, config, logger):
+        self.master = master
         self.config = config
         self.logger = logger
+        self.interval = config.get('ui', {}).get('interval')
+        self._results = queue.Queue()
+        self._worker = None
         self.frame = Frame(master)
         self.frame.pack()
         for i, text in enumerate(self.FIELDS):
@@ -28,31 +50,79 @@ class App:
         self.__close(row=2, column=2)
         self.__timestamp(row=3, column=0, columnspan=3)
 
+        if self.interval:
+            self.master.after(0, self.__auto_refresh)
+
     def refresh(self):
+        """Start taking readings in the background, unless already doing so."""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._worker = threading.Thread(target=self.__work, daemon=True)
+        self._worker.start()
+        self.master.after(self.POLL_INTERVAL, self.__poll)
+
+    def show(self, reading):
+        int_temp = reading.get('int_temp')
+        ext_temp = reading.get('ext_temp')
+        humidity = reading.get('humidity')
+        self.int_temp.set(_fahrenheit(int_temp))
+        self.ext_temp.set(_fahrenheit(ext_temp))
+        if humidity is None:
+            self.humidity.set('—')
+        else:
+            self.humidity.set('{:.1f}%'.format(humidity))
+        timestamp = datetime.now().strftime('%b %-d %Y %H:%M:%S')
+        self.timestamp.set('Last measurement taken {}'.format(timestamp))
+
+    def cached(self):
+        """Return the latest reading from the cache, if it is fresh."""
+        if 'cache' not in self.config:
+            return None
+        return Cache(**self.config['cache']).load()
+
+    def measure(self):
+        """Read the sensors, unless another process holds the lock."""
+        if not utils.lock(logger=self.logger, timeout=0):
+            return None
         try:
-            utils.lock(logger=self.logger)
-
-            sensor = self.config['internal']['sensor']
-            kwargs = self.config['internal']['options']
-            int_temp = utils.lookup_sensor(sensor).read(**kwargs)
-            self.int_temp.set('{:.1f}°F'.format(int_temp * 9/5 + 32))
-
-            sensor = self.config['temperature']['sensor']
-            kwargs = self.config['temperature']['options']
-            ext_temp, humidity = utils.lookup_sensor(sensor).read(**kwargs)
-            self.ext_temp.set('{:.1f}°F'.format(ext_temp * 9/5 + 32))
-            if humidity is None:
-                self.humidity.set('—')
-            else:
-                self.humidity.set('{:.1f}%'.format(humidity))
-            timestamp = datetime.now().strftime('%b %-d %Y %H:%M:%S')
-            self.timestamp.set('Last measurement taken {}'.format(timestamp))
+            channels = [
+                channel for channel in utils.load_channels(self.config)
+                if self.SHOWN.intersection(channel['fields'])
+            ]
+            health = Health(**self.config['health']) if 'health' in self.config else None
+            readings = utils.read_sensors(channels, self.logger, health=health)
         finally:
             utils.unlock(self.logger)
+        return utils.to_fields(channels, readings)
 
     def close(self):
         exit(0)
 
+    def __work(self):
+        try:
+            reading = self.cached() or self.measure()
+            message = 'Sensors are busy; try again shortly'
+        except Exception:
+            self.logger.exception('Failed to refresh readings')
+            reading = None
+            message = 'Failed to take readings'
+        self._results.put((reading, message))
+
+    def __poll(self):
+        try:
+            reading, message = self._results.get_nowait()
+        except queue.Empty:
+            self.master.after(self.POLL_INTERVAL, self.__poll)
+            return
+        if reading is None:
+            self.timestamp.set(message)
+        else:
+            self.show(reading)
+
+    def __auto_refresh(self):
+        self.refresh()
+        self.master.after(int(self.interval * 1000), self.__auto_refresh)
+
     def __int_temp(self, **kwargs):
         self.int_temp = StringVar()
         label = Label(self.frame, textvariable=self.int_temp)
@@ -88,6 +158,11 @@ class App:
         button.config(font=('Ubuntu', 24))
 
 
+def _fahrenheit(temp):
+    if temp is None:
+        return '—'
+    return '{:.1f}°F'.format(temp * 9/5 + 32)
+
 def main():
     args = utils.parse_args()
     config = utils.load_config(args.config)
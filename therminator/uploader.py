@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = metrics.gauge(
+    'therminator_upload_queue_depth',
+    'Readings waiting for the upload worker',
+)
+QUEUE_SECONDS = metrics.histogram(
+    'therminator_upload_queue_seconds',
+    'Time from queueing each reading until the upload worker delivered it',
+)
+DROPPED = metrics.counter(
+    'therminator_upload_dropped_total',
+    'Readings dropped because the upload queue was full',
+)
+
+class Uploader:
+    """Background thread that posts readings from a bounded queue.
+
+    Measurement cycles only put readings on the queue, so a slow or
+    unreachable server (and the client's backoff between retries) never
+    delays the next cycle. If the queue is full, the oldest reading is
+    dropped to make room.
+    """
+
+    def __init__(self, deliver, queue_size=1000, shutdown_timeout=30):
+        """
+        Keyword arguments:
+        deliver -- callable that posts a reading, retrying as it sees fit
+        queue_size -- maximum number of readings waiting to be posted
+                      (default: 1000)
+        shutdown_timeout -- seconds that stop() waits for queued readings to
+                            be posted (default: 30)
+        """
+        self.deliver = deliver
+        self.queue_size = queue_size
+        self.shutdown_timeout = shutdown_timeout
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='uploader', daemon=True)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queue)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, payload):
+        """Queue payload to be posted."""
+        with self._condition:
+            if len(self._queue) >= self.queue_size:
+                self._queue.popleft()
+                DROPPED.inc()
+                logger.warning('Upload queue full: dropped oldest reading')
+            self._queue.append((time.monotonic(), payload))
+            QUEUE_DEPTH.set(len(self._queue))
+            self._condition.notify()
+
+    def stop(self):
+        """Post the readings still queued, waiting up to shutdown_timeout."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(self.shutdown_timeout)
+        if self._thread.is_alive():
+            logger.warning('Upload worker still busy: %d reading(s) not posted', len(self) + 1)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                queued, payload = self._queue.popleft()
+                QUEUE_DEPTH.set(len(self._queue))
+            try:
+                self.deliver(payload)
+            except Exception:
+                logger.exception('Failed to post reading')
+            QUEUE_SECONDS.observe(time.monotonic() - queued)
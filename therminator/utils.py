@@ -2,24 +2,69 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import atexit
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import importlib
 import logging
 import logging.config
+import logging.handlers
 import os
+import queue
+import threading
 import time
 import yaml
 
-from .led import LED, NullLED
-from .sensors import *
+from . import hardware
+from . import metrics
+from .deadline import Deadline
 
 LOCKFILE = '/var/tmp/therminator.lock'
 
+# Lock file held by this process, if any.
+_lockfile = None
+
+# Sensor modules by name. A module given as a dotted path is only imported
+# when lookup_sensor() first resolves it, so drivers for sensors that are not
+# configured (and the libraries they depend on) are never loaded.
 SENSORS = {
-    'pi': pi,
-    'dht22': dht22,
-    'ds18b20': ds18b20,
-    'photoresistor': photoresistor,
+    'pi': 'therminator.sensors.pi',
+    'dht22': 'therminator.sensors.dht22',
+    'ds18b20': 'therminator.sensors.ds18b20',
+    'photoresistor': 'therminator.sensors.photoresistor',
 }
 
+# Held while reading a sensor whose driver sets EXCLUSIVE, so no two such
+# sensors are read at once, even though channels are read concurrently.
+# Adafruit_DHT.read is C code that holds the GIL for its whole ~500ms start
+# pulse and bit-bang, so any Python thread timing GPIO edges at the same time
+# (the photoresistor's microsecond charge timing, in poll or edge mode) would
+# see its samples inflated by hundreds of milliseconds.
+_exclusive = threading.Lock()
+
+# Entry point group through which other packages can provide sensors.
+ENTRY_POINT_GROUP = 'therminator.sensors'
+
+# Payload fields filled by the sensor in each section of configs that
+# predate channels.
+SECTIONS = collections.OrderedDict([
+    ('internal', ['int_temp']),
+    ('temperature', ['ext_temp', 'humidity']),
+    ('light', ['resistance']),
+])
+
+READ_SECONDS = metrics.histogram(
+    'therminator_sensor_read_seconds',
+    'Time taken to read each sensor',
+    labels=('channel', 'sensor'),
+)
+READ_FAILURES = metrics.counter(
+    'therminator_sensor_failures_total',
+    'Sensor reads that raised an error',
+    labels=('channel', 'sensor'),
+)
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -38,6 +83,23 @@ def parse_args():
         action='store_true',
         help='Dry run -- do not post data to API',
     )
+    parser.add_argument(
+        '-D', '--daemon',
+        action='store_true',
+        help='Run continuously, taking readings every --interval seconds',
+    )
+    parser.add_argument(
+        '-i', '--interval',
+        metavar='N',
+        type=float,
+        default=60,
+        help='Seconds between readings in daemon mode (default: 60)',
+    )
+    parser.add_argument(
+        '-s', '--simulate',
+        action='store_true',
+        help='Use simulated hardware instead of a Raspberry Pi',
+    )
     return parser.parse_args()
 
 def load_config(file):
@@ -45,32 +107,350 @@ def load_config(file):
         return yaml.safe_load(f)
 
 def setup_logger(config, debug=False):
+    """Configure logging from config, a logging.config dictionary.
+
+    If config has 'queue: true', the configured handlers are moved onto a
+    background thread. Loggers then only put records on a queue, and the
+    records are formatted and written (e.g., to syslog) off the read path.
+    """
+    config = dict(config)
+    use_queue = config.pop('queue', False)
     logging.config.dictConfig(config)
     logging.captureWarnings(capture=True)
     if debug:
         logging.basicConfig(level=logging.DEBUG)
+    if use_queue:
+        for name in [None] + list(config.get('loggers', {})):
+            _queue_handlers(logging.getLogger(name))
     return logging.getLogger('therminator')
 
+def _queue_handlers(logger):
+    """Move the handlers of logger onto a QueueListener thread."""
+    handlers = list(logger.handlers)
+    if not handlers:
+        return
+    records = queue.Queue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(_QueueHandler(records))
+    listener = _QueueListener(records, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+
+def register_sensor(name, sensor):
+    """Register a sensor under name.
+
+    Keyword arguments:
+    name -- the name used for the sensor in the config file
+    sensor -- a module (or any object) with a read() function, or the dotted
+              path of a module to import when the sensor is first used
+
+    The sensor may also have a prepare() function, which read_sensors() calls
+    with the list of options of all of the sensor's channels before they
+    are read. A sensor that holds the GIL for long stretches, or whose
+    timing is skewed when another thread does, should set EXCLUSIVE = True
+    so that it is never read at the same time as another such sensor.
+    """
+    SENSORS[name] = sensor
+
 def lookup_sensor(name):
-    return SENSORS[name]
+    """Return the sensor registered under name, importing it if necessary.
+
+    Sensors not in SENSORS are looked up among the entry points in the
+    therminator.sensors group, e.g., in a plugin's setup.py:
+
+        entry_points={
+            'therminator.sensors': ['bme280 = therminator_bme280'],
+        }
+    """
+    if name not in SENSORS:
+        SENSORS[name] = _load_entry_point(name)
+    sensor = SENSORS[name]
+    if isinstance(sensor, str):
+        sensor = importlib.import_module(sensor)
+        SENSORS[name] = sensor
+    return sensor
+
+def _load_entry_point(name):
+    try:
+        from importlib.metadata import entry_points
+        if hasattr(entry_points(), 'select'):
+            candidates = entry_points().select(group=ENTRY_POINT_GROUP)
+        else:
+            candidates = entry_points().get(ENTRY_POINT_GROUP, [])
+    except ImportError:
+        import pkg_resources
+        candidates = pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+    for entry_point in candidates:
+        if entry_point.name == name:
+            return entry_point.load()
+    raise KeyError('Unknown sensor: {}'.format(name))
+
+def setup_gpio():
+    """Set the GPIO pin numbering mode, if GPIO is available."""
+    try:
+        GPIO = hardware.gpio()
+    except ImportError:
+        return
+    GPIO.setmode(GPIO.BCM)
+
+def cleanup_gpio():
+    try:
+        GPIO = hardware.gpio()
+    except ImportError:
+        return
+    GPIO.cleanup()
+
+def load_channels(config):
+    """Return the channels to read, as configured in config.
+
+    Each channel is a dictionary with a name, the name of its sensor (see
+    SENSORS), the options passed to the sensor's read() function, the
+    payload fields filled by its reading and, optionally, its own sampling
+    interval. Channels are configured as a list, e.g.:
+
+        channels:
+          - sensor: ds18b20
+            field: ext_temp
+            options: {device: '28-000008763d4a'}
+          - sensor: dht22
+            fields: [ext_temp2, humidity]
+            options: {pin: 2}
+
+    Configs without channels are read from their internal, temperature and
+    light sections instead, which fill the fields in SECTIONS.
+    """
+    if 'channels' in config:
+        specs = config['channels']
+    else:
+        specs = []
+        for section, fields in SECTIONS.items():
+            if section in config:
+                spec = dict(config[section], fields=fields)
+                spec.setdefault('name', section)
+                specs.append(spec)
+
+    channels = []
+    names = set()
+    fields = set()
+    for spec in specs:
+        channel = _channel(spec)
+        if channel['name'] in names:
+            raise ValueError('Duplicate channel: {}'.format(channel['name']))
+        names.add(channel['name'])
+        for field in channel['fields']:
+            if field in fields:
+                raise ValueError('Duplicate field: {}'.format(field))
+            fields.add(field)
+        channels.append(channel)
+    return channels
 
-def lock(logger, retries=120):
+def _channel(spec):
+    if 'fields' in spec:
+        fields = list(spec['fields'])
+    elif 'field' in spec:
+        fields = [spec['field']]
+    else:
+        raise ValueError('Channel has no field: {}'.format(spec))
+    channel = dict(
+        name=spec.get('name', fields[0]),
+        sensor=spec['sensor'],
+        options=spec.get('options', {}),
+        fields=fields,
+    )
+    if 'interval' in spec:
+        channel['interval'] = spec['interval']
+    return channel
+
+def to_fields(channels, readings):
+    """Return the payload fields filled by the readings of channels.
+
+    Keyword arguments:
+    channels -- the channels that were read
+    readings -- dictionary mapping each channel's name to its reading
+
+    A reading that is a tuple fills the channel's fields in order, and any
+    other reading fills its only field. A missing or failed reading leaves
+    its fields None.
+    """
+    fields = collections.OrderedDict()
+    for channel in channels:
+        reading = readings.get(channel['name'])
+        if isinstance(reading, (tuple, list)):
+            values = list(reading)
+        else:
+            values = [reading]
+        values += [None] * (len(channel['fields']) - len(values))
+        for field, value in zip(channel['fields'], values):
+            fields[field] = value
+    return fields
+
+def read_sensors(channels, logger, health=None):
+    """Read the sensors of all channels concurrently.
+
+    Keyword arguments:
+    channels -- the channels to read (see load_channels())
+    logger -- logger used to report sensor failures
+    health -- a health.Health used to skip failing sensors (default: None)
+
+    Returns a dictionary mapping each channel's name to its reading. Each
+    sensor keeps its own timeout; if a sensor raises, the failure is logged
+    and its channel maps to None so the other readings are not lost. Sensors
+    that set EXCLUSIVE (the DHT22 and photoresistor) are read one at a time
+    (see read_sensor()).
+
+    Each sensor's channels are read once prepare_sensor() has been called
+    with their options, so that, e.g., all DS18B20 probes on a bus convert
+    at once.
+    """
+    groups = collections.OrderedDict()
+    for channel in channels:
+        if health is None or health.state(channel['name']) != 'open':
+            groups.setdefault(channel['sensor'], []).append(channel['options'])
+
+    readings = {}
+    with ThreadPoolExecutor(max_workers=max(len(channels) + len(groups), 1)) as executor:
+        prepared = {}
+        for sensor, options in groups.items():
+            prepared[sensor] = executor.submit(prepare_sensor, sensor, options, logger)
+        futures = collections.OrderedDict()
+        for channel in channels:
+            futures[channel['name']] = executor.submit(
+                _read_prepared, prepared.get(channel['sensor']), channel, logger, health)
+        for name, future in futures.items():
+            readings[name] = future.result()
+    return readings
+
+def _read_prepared(prepared, channel, logger, health):
+    if prepared is not None:
+        prepared.result()
+    return read_sensor(channel, logger, health)
+
+def prepare_sensor(name, options, logger):
+    """Call sensor name's prepare() function, if it has one.
+
+    Keyword arguments:
+    name -- the name of the sensor
+    options -- list of the options of each channel about to be read
+    logger -- logger used to report failures
+
+    A failure is only logged, since the channels can still be read without.
+    """
+    try:
+        prepare = getattr(lookup_sensor(name), 'prepare', None)
+        if prepare is not None:
+            prepare(options)
+    except Exception as e:
+        logger.warning('Failed to prepare %s sensor: %r', name, e)
+
+def read_sensor(channel, logger, health=None):
+    """Read the sensor of channel, returning None if it fails.
+
+    If health is given, a sensor that has been failing is skipped (returning
+    None) until its circuit breaker lets a probe through. If the sensor sets
+    EXCLUSIVE, it is read while holding a lock shared by all such sensors,
+    whichever thread reads them (e.g., in read_sensors() or the daemon's
+    scheduler).
+    """
+    name = channel['name']
+    if health is not None and not health.allow(name):
+        return None
+    try:
+        sensor = lookup_sensor(channel['sensor'])
+        exclusive = getattr(sensor, 'EXCLUSIVE', False)
+        if exclusive:
+            _exclusive.acquire()
+        try:
+            with READ_SECONDS.time(channel=name, sensor=channel['sensor']):
+                reading = sensor.read(**channel['options'])
+        finally:
+            if exclusive:
+                _exclusive.release()
+    except Exception as e:
+        READ_FAILURES.inc(channel=name, sensor=channel['sensor'])
+        logger.error('Failed to read %s sensor: %r', name, e)
+        if health is not None:
+            health.failure(name)
+        return None
+    if health is not None:
+        health.success(name)
+    return reading
+
+def lock(logger, timeout=120):
+    """Acquire the lock shared by all therminator processes.
+
+    The lock is an flock on LOCKFILE, so the kernel releases it if the
+    process holding it dies. The file records the holder's PID while it is
+    held. It is left in place between runs, so it is made writable by
+    everyone: a client run as another user (e.g., the UI, when cron runs as
+    root) can then still take the lock. Waits up to timeout seconds and
+    returns True if the lock was acquired.
+    """
+    global _lockfile
     logger.debug('Acquiring lock')
-    for i in range(retries):
+    deadline = Deadline(timeout)
+    try:
+        f = _open_lockfile()
+    except OSError as e:
+        logger.error('Failed to open lock file %s: %r', LOCKFILE, e)
+        return False
+    while True:
         try:
-            with open(LOCKFILE, 'x') as f:
-                f.write(str(os.getpid()))
-            logger.debug('Lock acquired')
-            return
-        except FileExistsError:
-            time.sleep(1)
-            continue
-    logger.error('Failed to acquire lock')
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if deadline.expired():
+                logger.error('Failed to acquire lock (held by process %s)', _lock_holder(f))
+                f.close()
+                return False
+            time.sleep(min(0.1, deadline.remaining()))
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    _lockfile = f
+    logger.debug('Lock acquired')
+    return True
 
 def unlock(logger):
-    try:
-        logger.debug('Relinquishing lock')
-        os.unlink(LOCKFILE)
-        logger.debug('Lock relinquished')
-    except OSError:
+    global _lockfile
+    if _lockfile is None:
         logger.warning('No lock to relinquish')
+        return
+    logger.debug('Relinquishing lock')
+    _lockfile.truncate(0)
+    fcntl.flock(_lockfile, fcntl.LOCK_UN)
+    _lockfile.close()
+    _lockfile = None
+    logger.debug('Lock relinquished')
+
+def _open_lockfile():
+    fd = os.open(LOCKFILE, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        # The mode given to os.open is masked by the umask.
+        os.fchmod(fd, 0o666)
+    except PermissionError:
+        # Owned by another user, who will have set the mode when creating it.
+        pass
+    return os.fdopen(fd, 'r+')
+
+def _lock_holder(f):
+    f.seek(0)
+    try:
+        return int(f.read())
+    except ValueError:
+        return None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Leave formatting the message to the listener's thread.
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def handle(self, record):
+        # Respect the level of each handler, as Logger.callHandlers does.
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)